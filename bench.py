@@ -0,0 +1,293 @@
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from os import environ, link, listdir, makedirs, remove
+from os.path import exists, join
+from random import Random
+from shutil import copyfile
+from statistics import mean, median
+from time import perf_counter
+import json
+import platform
+import sys
+
+from yaml import dump
+
+
+def make_config(root, rows):
+    return {
+        'db': {
+            'columns': [
+                'num_stars', 'good',
+                {'key': 'num_votes', 'type': 'int', 'title': 'Votes'},
+                {'key': 'liked', 'type': 'bool', 'title': 'Liked'},
+            ],
+            'pics': {
+                'local': join(root, 'library'),
+                'remote': join(root, 'remote') + '/',
+                'staging': join(root, 'staging'),
+                'renditions': {'path': join(root, 'renditions')},
+            },
+            'pickers': [
+                {'Good': ['good == True']},
+                {'Stars': [[2.0, 'num_stars > 3'], ['num_stars <= 3', 'liked == True']]},
+            ],
+            'status': {
+                'local': join(root, 'status.yaml'),
+                'remote': join(root, 'status.remote.yaml'),
+                'pickers': {'plus': ['good == True'], 'minus': []},
+                'games': {
+                    'bestof': {
+                        'picker': [['good == True'], ['num_votes > 10']],
+                        'trigger': 'num_stars > 2',
+                        'value': 'num_stars + 1',
+                    },
+                    'permission': {
+                        'value': 'num_stars + min(num_votes, 5)',
+                        'num': 10, 'prob': 0.4, 'break': 10, 'margins': [0.5, 1.5],
+                        'our_picker': ['good == True'],
+                        'your_picker': ['good == False'],
+                    },
+                },
+            },
+        },
+    }
+
+
+def make_status(config):
+    now = datetime.now()
+    data = {
+        'points': 10, 'leader': 'us', 'last_mas': now.date(), 'last_checkin': now.date(),
+        'streak': 0, 'next_mas_add': 1, 'perm_until': now - timedelta(hours=1),
+        'ask_blocked_until': now - timedelta(hours=1),
+    }
+    for key in ['local', 'remote']:
+        with open(config[key], 'w') as f:
+            dump(data, f, default_flow_style=False)
+
+
+def make_placeholder(fn):
+    from PyQt5.QtGui import QColor, QImage
+
+    image = QImage(640, 480, QImage.Format_RGB32)
+    image.fill(QColor(96, 128, 160))
+    image.save(fn, 'JPG', 80)
+
+
+def populate(db, rows, seed, batch=50000):
+    from db import Picture
+
+    rng = Random(seed)
+    have = db.session.query(Picture.id).count()
+    for start in range(have, rows, batch):
+        db.engine.execute(db.table.insert(), [{
+            'extension': 'jpg',
+            'delt': False,
+            'num_stars': rng.randint(0, 5),
+            'good': rng.random() < 0.4,
+            'num_votes': int(rng.expovariate(0.1)),
+            'liked': rng.random() < 0.2,
+        } for _ in range(start, min(rows, start + batch))])
+    db.invalidate()
+
+
+def link_images(db, placeholder):
+    from db import Picture
+
+    present = set(listdir(Picture.root))
+    for idx, ext in db.session.query(Picture.id, Picture.extension):
+        name = Picture.basename(idx, ext)
+        if name in present:
+            continue
+        try:
+            link(placeholder, join(Picture.root, name))
+        except OSError:
+            copyfile(placeholder, join(Picture.root, name))
+
+
+class Headless:
+
+    def __init__(self, db):
+        self.db = db
+        self.programs = []
+
+    @property
+    def st(self):
+        return self.db.status
+
+    def register(self, program):
+        self.programs.append(program)
+
+    def unregister(self, *args, **kwargs):
+        if self.programs:
+            self.programs.pop()
+
+    def show_image(self, pic):
+        pass
+
+    def show_message(self, msg, align='center'):
+        return ''
+
+
+def timed(func, repeat, setup=None):
+    samples = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = perf_counter()
+        func()
+        samples.append(perf_counter() - start)
+    return {
+        'n': repeat,
+        'total': sum(samples),
+        'mean': mean(samples),
+        'median': median(samples),
+        'min': min(samples),
+        'max': max(samples),
+    }
+
+
+def bench_pickers(db, results, repeat):
+    good, stars = db.pickers[1][1], db.pickers[2][1]
+    results['list_picker.get.cold'] = timed(good.get, 1, setup=good.invalidate)
+    results['list_picker.get'] = timed(good.get, repeat)
+    results['union_picker.get.cold'] = timed(stars.get, 1, setup=db.invalidate)
+    results['union_picker.get'] = timed(stars.get, repeat)
+
+
+def bench_bestof(db, results, repeat):
+    from programs import BestOfGame
+
+    m = Headless(db)
+    game = BestOfGame(m)
+
+    def reset():
+        if game.done:
+            game.done = False
+            game.pts = {True: [0, 0, 0], False: [0, 0, 0]}
+
+    results['bestof.next'] = timed(lambda: game.next(m), repeat, setup=reset)
+
+
+def bench_permission(db, results, repeat):
+    from programs import PermissionProgram, solve_num_our
+
+    m = Headless(db)
+    st = db.status
+
+    def cold():
+        st.perm_ours.histograms.clear()
+        st.perm_yours.histograms.clear()
+        solve_num_our.cache_clear()
+
+    results['permission.setup.cold'] = timed(lambda: PermissionProgram(m), max(1, repeat // 100),
+                                             setup=cold)
+    results['permission.setup'] = timed(lambda: PermissionProgram(m), max(1, repeat // 10))
+
+    hist_our = st.perm_ours.histogram(st.perm_value)
+    hist_you = st.perm_yours.histogram(st.perm_value)
+    results['permission.num_our'] = timed(
+        lambda: PermissionProgram.num_our(hist_our, hist_you, st.perm_num, st.perm_prob),
+        max(1, repeat // 100), setup=solve_num_our.cache_clear,
+    )
+
+
+def bench_sync_local(db, results, repeat):
+    from db import Picture
+
+    snapshot = join(Picture.root, '.scan')
+
+    def cold():
+        if exists(snapshot):
+            remove(snapshot)
+
+    results['db.sync_local.cold'] = timed(db.sync_local, 1, setup=cold)
+    results['db.sync_local'] = timed(db.sync_local, max(1, repeat // 100))
+
+
+def bench_image_view(db, results, repeat):
+    from PyQt5.QtWidgets import QApplication
+    from gui_utils import ImageCache, ImageView
+
+    app = QApplication.instance() or QApplication(sys.argv)
+    pics = [db.pickers[0][1].get() for _ in range(max(1, repeat // 10))]
+
+    view = ImageView(ImageCache())
+    view.setFixedSize(1280, 800)
+    it = iter(pics * 2)
+    results['image_view.load.uncached'] = timed(lambda: view.load(next(it)), len(pics))
+
+    cache = ImageCache(budget=1024)
+    cache.prefetch(pics)
+    for pic in pics:
+        cache.get(pic)
+    view = ImageView(cache)
+    view.setFixedSize(1280, 800)
+    it = iter(pics)
+    results['image_view.load.cached'] = timed(lambda: view.load(next(it)), len(pics))
+    app.processEvents()
+
+
+BENCHMARKS = {
+    'pickers': bench_pickers,
+    'bestof': bench_bestof,
+    'permission': bench_permission,
+    'sync_local': bench_sync_local,
+    'image_view': bench_image_view,
+}
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark ptools against a synthetic library')
+    parser.add_argument('--root', default='bench-library')
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', action='append', choices=sorted(BENCHMARKS))
+    parser.add_argument('--output', default='-')
+    args = parser.parse_args()
+
+    environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    root = join(args.root, str(args.rows))
+    config = make_config(root, args.rows)
+    for key in ['local', 'staging']:
+        makedirs(config['db']['pics'][key], exist_ok=True)
+    with open(join(root, 'config.yaml'), 'w') as f:
+        dump(config, f, default_flow_style=False)
+    make_status(config['db']['status'])
+    placeholder = join(root, 'placeholder.jpg')
+    if not exists(placeholder):
+        make_placeholder(placeholder)
+
+    from db import DB
+
+    start = perf_counter()
+    db = DB(config['db'])
+    populate(db, args.rows, args.seed)
+    link_images(db, placeholder)
+    setup = perf_counter() - start
+
+    results = {}
+    for name in args.only or sorted(BENCHMARKS):
+        BENCHMARKS[name](db, results, args.repeat)
+
+    report = {
+        'rows': args.rows,
+        'repeat': args.repeat,
+        'seed': args.seed,
+        'setup': setup,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': datetime.now().isoformat(),
+        'results': results,
+    }
+    db.status.put()
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+from os import makedirs, replace
+from os.path import exists, join
+import json
+
+from sqlalchemy import select
+
+
+REVISION = [
+    'CREATE TABLE IF NOT EXISTS revision (id INTEGER PRIMARY KEY CHECK (id = 0), token INTEGER NOT NULL)',
+    'INSERT OR IGNORE INTO revision VALUES (0, random())',
+] + [
+    'CREATE TRIGGER IF NOT EXISTS revision_{0} AFTER {0} ON pictures '
+    'BEGIN UPDATE revision SET token = random(); END'.format(op)
+    for op in ['INSERT', 'UPDATE', 'DELETE']
+]
+
+
+class ColumnStore:
+
+    def __init__(self, path, engine, table):
+        self.path = path
+        self.engine = engine
+        self.table = table
+        self.keys = table.c.keys()
+        self.arrays = None
+        self.dirty = False
+        makedirs(path, exist_ok=True)
+
+    def install(self):
+        for statement in REVISION:
+            self.engine.execute(statement)
+
+    def revision(self, conn=None):
+        return (conn or self.engine).execute('SELECT token FROM revision').scalar()
+
+    @property
+    def columns(self):
+        if self.arrays is None and not self.load():
+            self.rebuild()
+        return self.arrays
+
+    def __len__(self):
+        return len(self.columns['id'])
+
+    def load(self):
+        import numpy as np
+
+        meta = join(self.path, 'meta.json')
+        if not exists(meta):
+            return False
+        with open(meta, 'r') as f:
+            meta = json.load(f)
+        if meta['keys'] != self.keys or meta['token'] != self.revision():
+            return False
+        self.arrays = {k: np.load(join(self.path, k + '.npy'), mmap_mode='c') for k in self.keys}
+        return True
+
+    def rebuild(self):
+        import numpy as np
+
+        cols = [self.table.c[k] for k in self.keys]
+        with self.engine.connect() as conn:
+            with conn.begin():
+                token = self.revision(conn)
+                rows = conn.execute(select(cols).order_by(self.table.c.id)).fetchall()
+        values = list(zip(*rows)) or [()] * len(cols)
+        self.arrays = {c.key: np.array(v, dtype=self.dtype(c, v)) for c, v in zip(cols, values)}
+        self.save(token)
+
+    @staticmethod
+    def dtype(column, values):
+        python_type = column.type.python_type
+        if python_type is str:
+            return 'U{}'.format(max(map(len, values), default=1))
+        return {bool: bool, int: 'i8'}[python_type]
+
+    def save(self, token=None):
+        import numpy as np
+
+        if token is None:
+            token = self.revision()
+        for k, array in self.arrays.items():
+            tmp = join(self.path, k + '.tmp.npy')
+            np.save(tmp, array)
+            replace(tmp, join(self.path, k + '.npy'))
+        tmp = join(self.path, 'meta.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'keys': self.keys, 'token': token, 'rows': len(self.arrays['id'])}, f)
+        replace(tmp, join(self.path, 'meta.json'))
+        self.dirty = False
+
+    def commit(self):
+        if self.dirty and self.arrays is not None:
+            self.save()
+
+    def invalidate(self):
+        self.arrays = None
+        self.dirty = False
+
+    def update(self, pics):
+        import numpy as np
+
+        if self.arrays is None or not pics:
+            return
+        rows = {pic.id: pic for pic in pics}
+        ids = self.arrays['id']
+        new = np.array(sorted(rows), dtype=ids.dtype)
+        pos = np.searchsorted(ids, new)
+        found = np.zeros(len(new), dtype=bool)
+        if len(ids):
+            found = (pos < len(ids)) & (ids[np.minimum(pos, len(ids) - 1)] == new)
+        values = {k: np.array([getattr(rows[i], k) for i in new.tolist()]) for k in self.keys}
+        widen = any(v.dtype.kind == 'U' and v.dtype.itemsize > self.arrays[k].dtype.itemsize
+                    for k, v in values.items())
+        if found.all() and not widen:
+            for k, v in values.items():
+                self.arrays[k][pos] = v
+        else:
+            self.remove(new[found].tolist())
+            order = np.argsort(np.concatenate([self.arrays['id'], new]), kind='stable')
+            self.arrays = {k: np.concatenate([self.arrays[k], values[k]])[order] for k in self.keys}
+        self.dirty = True
+
+    def remove(self, ids):
+        import numpy as np
+
+        if self.arrays is None or not len(ids):
+            return
+        keep = ~np.isin(self.arrays['id'], np.asarray(list(ids)))
+        if not keep.all():
+            self.arrays = {k: v[keep] for k, v in self.arrays.items()}
+            self.dirty = True
+
+    def mask(self, expressions):
+        import numpy as np
+
+        cols = self.columns
+        n = len(cols['id'])
+        mask = np.ones(n, dtype=bool)
+        for expr in expressions:
+            mask &= expr.vector(cols, n).astype(bool)
+        return mask
@@ -0,0 +1,54 @@
+from hashlib import sha1
+from os import replace
+from os.path import abspath, basename, dirname, getmtime, join
+import marshal
+import pickle
+import sys
+
+from yaml import load
+try:
+    from yaml import CSafeLoader as Loader
+except ImportError:
+    from yaml import SafeLoader as Loader
+
+import expressions
+
+
+def load_yaml(stream):
+    return load(stream, Loader=Loader)
+
+
+class ConfigCache:
+
+    def __init__(self, path):
+        self.path = path
+        self.cache = join(dirname(abspath(path)), '.{}.cache'.format(basename(path)))
+        with open(path, 'rb') as f:
+            raw = f.read()
+        salt = '{}|{}'.format(sys.version, getmtime(expressions.__file__)).encode()
+        self.key = sha1(raw + salt).hexdigest()
+        self.hit = self.load()
+        if not self.hit:
+            self.config = load_yaml(raw)
+
+    def load(self):
+        try:
+            with open(self.cache, 'rb') as f:
+                if pickle.load(f) != self.key:
+                    return False
+                self.config = pickle.load(f)
+                expressions.COMPILED.update(marshal.load(f))
+        except (OSError, EOFError, ValueError, TypeError, pickle.UnpicklingError):
+            return False
+        return True
+
+    def save(self):
+        if self.hit:
+            return
+        tmp = self.cache + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(self.key, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(self.config, f, pickle.HIGHEST_PROTOCOL)
+            marshal.dump(dict(expressions.COMPILED), f)
+        replace(tmp, self.cache)
+        self.hit = True
@@ -1,55 +1,529 @@
+from collections import Counter, deque
+from hashlib import sha1
 from datetime import datetime, date, timedelta
-from os import listdir, sep
-from os.path import abspath, basename, expanduser, isfile, join
-from random import random, choice, uniform
-from subprocess import run, PIPE
-from yaml import dump, load
+from itertools import islice
+from os import fsync, listdir, replace, scandir, stat
+from os.path import abspath, dirname, exists, expanduser, join
+from random import random, choice, randint
+from subprocess import DEVNULL, Popen, run
+from weakref import WeakSet
+from yaml import dump
+import pickle
 
-from sqlalchemy import create_engine, Boolean, Column, Integer, MetaData, String, Table
-from sqlalchemy.orm import mapper, create_session
-from sqlalchemy.sql import func
+from sqlalchemy import and_, create_engine, event, literal_column, Boolean, Column, Integer, MetaData, String, Table
+from sqlalchemy.orm import mapper, create_session, object_session
+from sqlalchemy.sql import func, select
+from sqlalchemy.sql.expression import ColumnClause
+from sqlalchemy.sql.visitors import replacement_traverse
+
+from columnar import ColumnStore
+from compiled import load_yaml
+from expressions import Expression
+from fileops import Journal
+from renditions import RenditionCache
+from sync import Debouncer, Transfer, pull, push, tracked
+from timing import log
+
+
+INGEST = {
+    'duplicates': 'flag',
+    'distance': 4,
+    'batch': 50,
+    'backfill': 2000,
+}
+
+
+STREAM_CHUNK = 4096
+
+
+PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 268435456,
+    'cache_size': -65536,
+    'temp_store': 'MEMORY',
+}
 
 
 class Picture:
 
+    shard = 0
+
+    @staticmethod
+    def basename(idx, ext):
+        return '{idx:0>8}.{ext}'.format(idx=idx, ext=ext)
+
+    @classmethod
+    def directory(cls, idx):
+        if not cls.shard:
+            return ''
+        return '{idx:0>8}'.format(idx=idx)[:-cls.shard]
+
+    @classmethod
+    def relpath(cls, idx, ext):
+        return join(cls.directory(idx), cls.basename(idx, ext))
+
     @property
     def filename(self):
-        return join(self.root, '{idx:0>8}.{ext}'.format(idx=self.id, ext=self.extension))
+        return join(self.root, self.relpath(self.id, self.extension))
+
+
+class IdIndex:
+
+    def __init__(self, ids=()):
+        self.ids = list(ids)
+        self.pos = {i: n for n, i in enumerate(self.ids)}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, idx):
+        return idx in self.pos
+
+    def add(self, idx):
+        if idx not in self.pos:
+            self.pos[idx] = len(self.ids)
+            self.ids.append(idx)
+
+    def discard(self, idx):
+        n = self.pos.pop(idx, None)
+        if n is None:
+            return
+        last = self.ids.pop()
+        if n < len(self.ids):
+            self.ids[n] = last
+            self.pos[last] = n
+
+    def choice(self):
+        return self.ids[int(random() * len(self.ids))]
+
+
+class AliasTable:
+
+    def __init__(self, weights):
+        n = len(weights)
+        total = sum(weights)
+        prob = [w * n / total for w in weights]
+        alias = list(range(n))
+        small = [i for i, p in enumerate(prob) if p < 1.0]
+        large = [i for i, p in enumerate(prob) if p >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            alias[s] = l
+            prob[l] -= 1.0 - prob[s]
+            (small if prob[l] < 1.0 else large).append(l)
+        for i in small + large:
+            prob[i] = 1.0
+        self.prob = prob
+        self.alias = alias
+
+    def __len__(self):
+        return len(self.prob)
+
+    def choice(self):
+        r = random() * len(self.prob)
+        i = int(r)
+        return i if r - i < self.prob[i] else self.alias[i]
+
+
+class Permutation:
+
+    def __init__(self, n, seed, rounds=4):
+        self.n = n
+        self.seed = seed
+        bits = max(2, (n - 1).bit_length())
+        self.half = (bits + 1) // 2
+        self.mask = (1 << self.half) - 1
+        self.keys = [int.from_bytes(sha1('{}:{}'.format(seed, r).encode()).digest()[:8], 'big')
+                     for r in range(rounds)]
+
+    def round(self, x, key):
+        x = (x * 0x9E3779B97F4A7C15 + key) & 0xFFFFFFFFFFFFFFFF
+        return (x ^ x >> 29) & self.mask
+
+    def __call__(self, i):
+        while True:
+            left, right = i >> self.half, i & self.mask
+            for key in self.keys:
+                left, right = right, left ^ self.round(right, key)
+            i = left << self.half | right
+            if i < self.n:
+                return i
+
+
+class ShuffleBag:
+
+    def __init__(self, state, changed):
+        self.state = state
+        self.changed = changed
+        self.perm = None
+        self.free = list(state.setdefault('pending', []))
+
+    def next(self, n):
+        self.free = [i for i in self.free if i < n]
+        if self.free:
+            i = self.free.pop(0)
+        else:
+            if self.state['cursor'] >= n:
+                self.state.update(seed=randint(0, 1 << 62), cursor=0, pending=[])
+            i = self.state['cursor']
+            self.state['cursor'] += 1
+            self.state['pending'].append(i)
+            self.changed(user=False)
+        if self.perm is None or self.perm.n != n or self.perm.seed != self.state['seed']:
+            self.perm = Permutation(n, self.state['seed'])
+        return (self.state['seed'], i), self.perm(i)
+
+    def take(self, slot):
+        seed, i = slot
+        if seed == self.state['seed'] and i in self.state['pending']:
+            self.state['pending'].remove(i)
+            self.changed(user=False)
 
+    def drop(self, slot):
+        seed, i = slot
+        if seed == self.state['seed'] and i in self.state['pending'] and i not in self.free:
+            self.free.append(i)
 
-class ListPicker:
 
-    def __init__(self, name, db, *filters):
+class Picker:
+
+    def pick(self):
+        leaf = self.leaf()
+        return leaf, leaf.draw()
+
+    def peek(self, n):
+        while len(self.queue) < n:
+            leaf, pic = self.pick()
+            if pic is None:
+                break
+            self.queue.append((leaf, pic))
+        return [pic for _, pic in islice(self.queue, n)]
+
+    def get(self):
+        while self.queue:
+            leaf, pic = self.queue.popleft()
+            leaf.taken(pic)
+            if leaf.valid(pic):
+                return pic
+        leaf, pic = self.pick()
+        if pic is not None:
+            leaf.taken(pic)
+        return pic
+
+    def clear(self):
+        for leaf, pic in self.queue:
+            leaf.dropped(pic)
+        self.queue.clear()
+
+
+class ListPicker(Picker):
+
+    def __init__(self, name, db, *filters, predicate=None, expressions=None):
         self.filters = filters
+        self.predicate = predicate
+        self.expressions = expressions if expressions is not None or filters else []
+        if self.expressions and not all(e.exact for e in self.expressions):
+            self.expressions = None
         self.db = db
         self.name = name
+        self.queue = deque()
+        self.histograms = {}
+        self.probed = False
+        self.slots = {}
+        self._index = None
+        self._key = None
 
-    def get(self):
-        return self.db.query().filter(*self.filters).order_by(func.random()).first()
+    @property
+    def key(self):
+        if self._key is None:
+            source = '{}|{}'.format(self.db.sql(and_(*self.filters)) if self.filters else '',
+                                    self.predicate.source if self.predicate is not None else '')
+            if self.db.label:
+                source = '{}|{}'.format(self.db.label, source)
+            self._key = sha1(source.encode()).hexdigest()[:16]
+        return self._key
+
+    @property
+    def index(self):
+        if self._index is None:
+            mask = self.mask()
+            if mask is not None:
+                self._index = IdIndex(self.db.store.columns['id'][mask].tolist())
+            elif self.predicate is None:
+                query = self.db.session.query(self.db.Picture.id).filter(*self.filters)
+                self._index = IdIndex(idx for idx, in query)
+            else:
+                self._index = IdIndex(self.columns(())['id'].tolist())
+        return self._index
+
+    def invalidate(self):
+        self._index = None
+        self.clear()
+        self.histograms.clear()
+
+    def passes(self, pic):
+        import numpy as np
+
+        if self.expressions is not None:
+            keys = set(self.db.table.c.keys())
+            try:
+                return all(e.vector({k: np.array([getattr(pic, k)]) for k in e.names & keys}, 1)[0]
+                           for e in self.expressions)
+            except (AttributeError, NameError, TypeError):
+                pass
+        query = self.db.session.query(self.db.Picture.id).filter(self.db.Picture.id == pic.id, *self.filters)
+        return query.first() is not None
+
+    def matches(self, pic):
+        if not self.passes(pic):
+            return False
+        return self.predicate is None or bool(self.predicate(pic))
+
+    def update(self, pic):
+        if self._index is None:
+            self.histograms.clear()
+            return
+        before, after = pic.id in self._index, self.matches(pic)
+        if after:
+            self._index.add(pic.id)
+        else:
+            self._index.discard(pic.id)
+        if before != after:
+            self.count(pic, 1 if after else -1)
+
+    def remove(self, idx, pic=None):
+        if self._index is None:
+            self.histograms.clear()
+        elif idx in self._index:
+            self._index.discard(idx)
+            if pic is None:
+                self.histograms.clear()
+            else:
+                self.count(pic, -1)
+
+    def count(self, pic, delta):
+        for expr, hist in self.histograms.items():
+            value = expr(pic)
+            hist[value] += delta
+            if hist[value] <= 0:
+                del hist[value]
+
+    def valid(self, pic):
+        return object_session(pic) is self.db.session and pic.id in self.index
+
+    def leaf(self):
+        return self
+
+    def leaves(self):
+        yield self
+
+    def flatten(self, weight):
+        if self.index:
+            yield self, weight
+
+    def probe(self):
+        ids = self.db.Picture.id
+        low, high = self.db.session.query(func.min(ids), func.max(ids)).one()
+        if low is None:
+            return None
+        query = self.db.query().filter(*self.filters).order_by(ids)
+        return query.filter(ids >= randint(low, high)).first() or query.first()
+
+    def draw(self):
+        if self._index is None and self.predicate is None and not self.probed and not self.db.shuffle:
+            self.probed = True
+            return self.probe()
+        if not self.index:
+            return None
+        if self.db.shuffle:
+            slot, pos = self.db.status.bag(self.key).next(len(self.index))
+            pic = self.db.query().get(self.index.ids[pos])
+            if pic is not None:
+                self.slots[pic.id] = slot
+            return pic
+        return self.db.query().get(self.index.choice())
+
+    def taken(self, pic):
+        slot = self.slots.pop(pic.id, None)
+        if slot is not None:
+            self.db.status.bag(self.key).take(slot)
+
+    def dropped(self, pic):
+        slot = self.slots.pop(pic.id, None)
+        if slot is not None:
+            self.db.status.bag(self.key).drop(slot)
 
     def get_all(self):
-        return self.db.query()
+        return self.db.query().filter(*self.filters)
+
+    def histogram(self, expr):
+        if expr not in self.histograms:
+            self.histograms[expr] = self.aggregate(expr)
+        return self.histograms[expr]
 
+    def mask(self):
+        if self.expressions is None:
+            return None
+        exprs = self.expressions + ([self.predicate] if self.predicate is not None else [])
+        try:
+            return self.db.store.mask(exprs)
+        except (AttributeError, NameError, TypeError):
+            self.expressions = None
+            return None
 
-class UnionPicker:
+    def keys(self, names):
+        return ['id'] + sorted(set(names) & set(self.db.table.c.keys()) - {'id'})
+
+    def chunks(self, names, size=STREAM_CHUNK):
+        import numpy as np
+
+        mask = self.mask()
+        if mask is not None:
+            cols = self.db.store.columns
+            keys = self.keys(names)
+            rows = np.flatnonzero(mask)
+            for start in range(0, len(rows), size):
+                selection = rows[start:start+size]
+                yield {k: cols[k][selection] for k in keys}
+            return
+
+        names = set(names)
+        if self.predicate is not None:
+            names |= self.predicate.names
+        keys = self.keys(names)
+        query = self.db.session.query(*(self.db.table.c[k] for k in keys)).filter(*self.filters)
+        rows = iter(query.yield_per(size))
+        for batch in iter(lambda: list(islice(rows, size)), []):
+            columns = {k: np.array(v) for k, v in zip(keys, zip(*batch))}
+            if self.predicate is not None:
+                mask = self.predicate.vector(columns, len(batch)).astype(bool)
+                columns = {k: v[mask] for k, v in columns.items()}
+            yield columns
+
+    def stream(self, names=(), expressions=(), size=STREAM_CHUNK):
+        expressions = [e if isinstance(e, Expression) else Expression(e) for e in expressions]
+        needed = set(names).union(*(e.names for e in expressions))
+        for columns in self.chunks(needed, size):
+            n = len(columns['id'])
+            chunk = {k: columns[k] for k in names}
+            for expr in expressions:
+                chunk[expr.source] = expr.vector(columns, n)
+            yield chunk
+
+    def aggregate(self, expr):
+        import numpy as np
+
+        if self.expressions is not None:
+            hist = Counter()
+            for chunk in self.stream(expressions=[expr]):
+                values, counts = np.unique(chunk[expr.source], return_counts=True)
+                hist.update(dict(zip(values.tolist(), counts.tolist())))
+            return hist
+
+        names = set(expr.names)
+        if self.predicate is not None:
+            names |= self.predicate.names
+        keys = sorted(names & set(self.db.table.c.keys()))
+        cols = [self.db.table.c[k] for k in keys]
+        query = self.db.session.query(*cols, func.count()).filter(*self.filters)
+        rows = query.group_by(*cols).all() if cols else query.all()
+        rows = [row for row in rows if row[-1]]
+
+        columns = {k: np.array(v) for k, v in zip(keys, zip(*rows))}
+        counts = [row[-1] for row in rows]
+        if self.predicate is not None:
+            mask = self.predicate.vector(columns, len(rows)).astype(bool)
+            counts = [c for c, m in zip(counts, mask) if m]
+            columns = {k: v[mask] for k, v in columns.items()}
+
+        hist = Counter()
+        for value, count in zip(expr.vector(columns, len(counts)).tolist(), counts):
+            hist[value] += count
+        return hist
+
+    def columns(self, names):
+        import numpy as np
+
+        mask = self.mask()
+        if mask is not None:
+            cols = self.db.store.columns
+            return {k: cols[k][mask] for k in self.keys(names)}
+
+        chunks = list(self.chunks(names, 1 << 16))
+        keys = chunks[0].keys() if chunks else self.keys(names)
+        if not chunks:
+            return {k: np.array([], dtype=int) for k in keys}
+        return {k: np.concatenate([c[k] for c in chunks]) for k in keys}
+
+    def split(self, predicate):
+        negated = Expression('not ({})'.format(predicate.source))
+        return (self.db.picker(self.name, *self.filters, predicate=predicate,
+                               expressions=self.expressions),
+                self.db.picker(self.name, *self.filters, predicate=negated,
+                               expressions=self.expressions))
+
+
+class UnionPicker(Picker):
 
     def __init__(self, name='Union'):
         self.pickers = []
         self.name = name
+        self.queue = deque()
+        self.table = None
 
     def add(self, picker, frequency=1.0):
         self.pickers.append((picker, float(frequency)))
+        self.clear()
+        self.table = None
 
-    def get(self):
-        max = sum(f for _, f in self.pickers)
-        r = uniform(0.0, max)
+    def leaves(self):
+        for p, _ in self.pickers:
+            yield from p.leaves()
 
+    def flatten(self, weight=1.0):
+        total = sum(f for _, f in self.pickers)
         for p, f in self.pickers:
-            r -= f
-            if r <= 0.0:
-                break
+            if f > 0.0:
+                yield from p.flatten(weight * f / total)
+
+    def build(self):
+        weights = {}
+        for leaf, weight in self.flatten():
+            weights[leaf] = weights.get(leaf, 0.0) + weight
+        self.dbs = {leaf.db for leaf in self.leaves()}
+        self.generation = self.revision()
+        self.flat = list(weights) or [next(self.leaves())]
+        self.table = AliasTable(list(weights.values()) or [1.0])
+
+    def revision(self):
+        return sum(db.generation for db in self.dbs)
 
-        return p.get()
+    def leaf(self):
+        if self.table is None or self.generation != self.revision():
+            self.build()
+        return self.flat[self.table.choice()]
+
+    def stream(self, names=(), expressions=(), size=STREAM_CHUNK):
+        for p, _ in self.pickers:
+            yield from p.stream(names, expressions, size)
+
+    def histogram(self, expr):
+        hist = Counter()
+        for leaf, weight in self.flatten():
+            counts = leaf.histogram(expr)
+            total = sum(counts.values())
+            for value, count in counts.items():
+                hist[value] += weight * count / total
+        return hist
+
+    def split(self, predicate):
+        true, false = UnionPicker(self.name), UnionPicker(self.name)
+        for picker, freq in self.pickers:
+            t, f = picker.split(predicate)
+            true.add(t, freq)
+            false.add(f, freq)
+        return true, false
 
 
 class Status:
@@ -57,20 +531,32 @@ class Status:
     def __init__(self, db, config):
         self.local = abspath(expanduser(config['local']))
         self.remote = config['remote']
+        self.touched = False
+        self.shuffle = {}
+        self.bags = {}
+        self.writer = Debouncer(self.write, delay=float(config.get('debounce', 2.0)))
+        self.pusher = Debouncer(self.push)
 
-        run(['rsync', '-av', self.remote, self.local])
+        self.pull = None
+        if exists(self.local):
+            self.pull = Transfer(
+                lambda t: t.rsync(self.remote, self.local + '.remote', track=False),
+                self.reconcile,
+            )
+        else:
+            run(['rsync', '-a', self.remote, self.local])
         with open(self.local, 'r') as f:
-            self.__dict__.update(load(f))
+            self.loaded = load_yaml(f)
+        self.__dict__.update(self.loaded)
 
         self.pickers = {name: db.picker_from_filters(filters, name)
                         for name, filters in config['pickers'].items()}
         self.bestof_picker = db.picker_from_filters(config['games']['bestof']['picker'])
-        self.bestof_trigger = lambda pic: eval(config['games']['bestof']['trigger'], None, pic.__dict__)
-        self.bestof_value = lambda pic: eval(config['games']['bestof']['value'], None, pic.__dict__)
+        self.bestof_trigger = Expression(config['games']['bestof']['trigger'])
+        self.bestof_pools = dict(zip((True, False), self.bestof_picker.split(self.bestof_trigger)))
+        self.bestof_value = Expression(config['games']['bestof']['value'])
 
-        self.perm_value = (
-            lambda pic: eval(config['games']['permission']['value'], None, pic.__dict__)
-        )
+        self.perm_value = Expression(config['games']['permission']['value'])
         self.perm_num = int(config['games']['permission']['num'])
         self.perm_prob = float(config['games']['permission']['prob'])
         self.perm_break = int(config['games']['permission']['break'])
@@ -78,6 +564,22 @@ class Status:
         self.perm_ours = db.picker_from_filters(config['games']['permission']['our_picker'])
         self.perm_yours = db.picker_from_filters(config['games']['permission']['your_picker'])
 
+    def reconcile(self):
+        if self.pull.error or not exists(self.local + '.remote'):
+            return
+        with open(self.local + '.remote', 'r') as f:
+            remote = load_yaml(f)
+        if remote == self.loaded or self.touched:
+            return
+        self.loaded = remote
+        self.__dict__.update(remote)
+        self.bags.clear()
+        self.update()
+
+    def changed(self, user=True):
+        self.touched = self.touched or user
+        self.writer.schedule(self.data())
+
     @property
     def pts(self):
         return self.points
@@ -116,6 +618,7 @@ class Status:
         self.leader = leader
         self.points = points
         self.next_mas_add = 0
+        self.changed()
 
     def update(self):
         msg = None
@@ -123,35 +626,70 @@ class Status:
         today = date.today()
         ndays = (today - self.last_checkin).days - 1
         if ndays > 0:
+            old_pts = self.points
             if self.you_leading:
                 self.update_points(sdelta=2*ndays)
             else:
                 self.update_points(sdelta=ndays)
-            if new_pts != self.points:
+            if old_pts != self.points:
                 msg = 'Added up to {} points for missing days'.format(ndays)
 
         self.last_checkin = today
+        self.changed(user=False)
         return msg
 
     def give_permission(self, permission, reduced=0):
         if permission:
             self.perm_until = datetime.now() + timedelta(minutes=60-reduced)
+            self.changed()
 
     def block_until(self, delta=None):
         if delta is None:
             delta = self.perm_break
         self.ask_blocked_until = datetime.now() + timedelta(minutes=delta)
+        self.changed()
 
     def can_ask_permission(self):
         return self.we_leading and datetime.now() > self.ask_blocked_until
 
-    def put(self):
+    def data(self):
         data = {key: getattr(self, key)
                 for key in ['points', 'leader', 'last_mas', 'last_checkin', 'streak',
                             'next_mas_add', 'perm_until', 'ask_blocked_until']}
-        with open(self.local, 'w') as f:
+        data['shuffle'] = {key: dict(state, pending=list(state.get('pending', [])))
+                           for key, state in self.shuffle.items()}
+        return data
+
+    def bag(self, key):
+        if key not in self.bags:
+            state = self.shuffle.setdefault(key, {'seed': randint(0, 1 << 62), 'cursor': 0})
+            self.bags[key] = ShuffleBag(state, self.changed)
+        return self.bags[key]
+
+    def write(self, data, push=True):
+        tmp = self.local + '.tmp'
+        with open(tmp, 'w') as f:
             dump(data, f, default_flow_style=False)
-        run(['rsync', '-av', self.local, self.remote])
+            f.flush()
+            fsync(f.fileno())
+        replace(tmp, self.local)
+        self.loaded = data
+        if push:
+            self.pusher.schedule()
+
+    def push(self, _):
+        if self.pull is not None:
+            self.pull.join()
+        run(['rsync', '-a', self.local, self.remote], check=True)
+
+    def put(self):
+        written, data = self.writer.cancel()
+        if written:
+            self.write(data, push=False)
+        pending, _ = self.pusher.cancel()
+        if written or pending:
+            Popen(['rsync', '-a', self.local, self.remote], start_new_session=True,
+                  stdout=DEVNULL, stderr=DEVNULL)
 
     def mas(self, skip=False):
         chg = 0
@@ -175,6 +713,7 @@ class Status:
                 return "That doesn't make sense"
 
         self.update_points(delta=chg)
+        self.changed()
         return '{}. Delta {:+}. New {}.'.format(pos, chg, self.points)
 
     def picker(self):
@@ -183,7 +722,7 @@ class Status:
 
 class DB:
 
-    def __init__(self, config):
+    def __init__(self, config, label=''):
         columns = [Column('id', Integer, primary_key=True),
                    Column('extension', String, nullable=False),
                    Column('delt', Boolean, nullable=False, default=False)]
@@ -202,34 +741,151 @@ class DB:
             columns.append(col)
         self.custom_columns = columns[3:]
 
+        self.label = label
+        self.Picture = type('Picture', (Picture,), {}) if label else Picture
+        self.Picture.db = self
         self.staging = abspath(expanduser(config['pics']['staging']))
         self.remote = config['pics']['remote']
-        Picture.root = abspath(expanduser(config['pics']['local']))
+        self.Picture.root = abspath(expanduser(config['pics']['local']))
+        self.Picture.shard = int(config['pics'].get('shard', 0))
+        self.shuffle = bool(config.get('shuffle', False))
+        self.ingest = dict(INGEST, **config['pics'].get('ingest', {}))
+
+        renditions = config['pics'].get('renditions', {})
+        self.renditions = RenditionCache(
+            abspath(expanduser(renditions.get('path', self.Picture.root + '.renditions'))),
+            limit=int(renditions.get('limit', 2048)),
+        )
 
-        path = abspath(join(Picture.root, 'plib.db'))
-        self.engine = create_engine('sqlite:///{}'.format(path))
+        path = abspath(join(self.Picture.root, 'plib.db'))
+        self.engine = create_engine('sqlite:///{}'.format(path),
+                                    connect_args={'check_same_thread': False})
+        self.pragmas = dict(PRAGMAS, **config.get('pragmas', {}))
+        event.listen(self.engine, 'connect', self.configure)
         metadata = MetaData(bind=self.engine)
         table = Table('pictures', metadata, *columns)
+        self.hashes = Table('hashes', metadata,
+                            Column('id', Integer, primary_key=True),
+                            Column('sha', String, nullable=False),
+                            Column('dhash', Integer))
         metadata.create_all()
-        mapper(Picture, table)
+        mapper(self.Picture, table)
+        self.table = table
+        self.store = ColumnStore(
+            abspath(expanduser(config['pics'].get('columns', self.Picture.root + '.columns'))),
+            self.engine, table,
+        )
+        self.store.install()
 
-        self.pickers = [self.picker()]
+        self.list_pickers = WeakSet()
+        self.generation = 0
+        self.compiled = {}
+        self.clauses = {}
+        self.pickers = [('&All', self.picker_from_filters())]
         for p in config['pickers']:
             name, filters = next(iter(p.items()))
-            self.pickers.append(self.picker_from_filters(filters, name))
+            self.pickers.append((name, self.picker_from_filters(filters, name)))
 
-        self.status = Status(self, config['status'])
+        self.status = Status(self, config['status']) if not label else None
+        self.create_indexes()
         self.update_session()
+        self.replay()
+        if config.get('explain'):
+            for name, plan in self.query_plans():
+                log.info('%s\n  %s', name, '\n  '.join(plan))
+
+    def configure(self, conn, record):
+        cursor = conn.cursor()
+        for key, value in self.pragmas.items():
+            cursor.execute('PRAGMA {} = {}'.format(key, value))
+        cursor.close()
+
+    def release(self):
+        self.session.close()
+        self.engine.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self.engine.dispose()
+
+    def sql(self, clause):
+        clause = replacement_traverse(
+            clause, {}, lambda e: literal_column(e.name) if isinstance(e, ColumnClause) else None
+        )
+        return str(clause.compile(self.engine, compile_kwargs={'literal_binds': True}))
+
+    def index_specs(self):
+        specs = {(('id',), self.sql(self.Picture.delt == True))}
+        for picker in list(self.list_pickers):
+            if not picker.filters:
+                continue
+            names = picker.predicate.names if picker.predicate is not None else set()
+            cols = ('id',) + tuple(sorted(names & set(self.table.c.keys()) - {'id'}))
+            specs.add((cols, self.sql(and_(*picker.filters))))
+        return sorted(specs)
+
+    def create_indexes(self):
+        wanted = {}
+        for cols, where in self.index_specs():
+            key = '{}|{}'.format(','.join(cols), where)
+            name = 'ix_auto_' + sha1(key.encode()).hexdigest()[:12]
+            wanted[name] = 'CREATE INDEX IF NOT EXISTS {} ON pictures ({}) WHERE {}'.format(
+                name, ', '.join(cols), where
+            )
+        existing = {name for name, in self.engine.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'ix_auto_%'"
+        )}
+        for name in existing - set(wanted):
+            self.engine.execute('DROP INDEX {}'.format(name))
+        for name in set(wanted) - existing:
+            self.engine.execute(wanted[name])
+
+    def query_plans(self):
+        plans = []
+        for picker in list(self.list_pickers):
+            query = self.session.query(self.Picture.id).filter(*picker.filters)
+            sql = str(query.statement.compile(self.engine, compile_kwargs={'literal_binds': True}))
+            rows = self.engine.execute('EXPLAIN QUERY PLAN ' + sql)
+            plans.append((picker.name, [row[-1] for row in rows]))
+        return plans
 
     def update_session(self):
         if hasattr(self, 'session'):
             self.session.close()
         self.session = create_session(bind=self.engine, autocommit=False, autoflush=True)
 
+    def invalidate(self):
+        self.generation += 1
+        self.store.invalidate()
+        for picker in self.list_pickers:
+            picker.invalidate()
+
+    def updated(self, *pics):
+        self.generation += 1
+        self.store.update(pics)
+        for picker in self.list_pickers:
+            for pic in pics:
+                picker.update(pic)
+
+    def removed(self, *ids):
+        self.generation += 1
+        self.store.remove(ids)
+        for picker in self.list_pickers:
+            for idx in ids:
+                picker.remove(idx)
+
     def query(self):
-        return self.session.query(Picture)
+        return self.session.query(self.Picture)
 
     def picker_from_filters(self, filters=[], name='&All'):
+        key = repr(filters)
+        if key not in self.compiled:
+            self.compiled[key] = self.compile_picker(filters, name)
+        return self.compiled[key]
+
+    def clause(self, expr):
+        if expr.source not in self.clauses:
+            self.clauses[expr.source] = eval(expr.code, None, self.Picture.__dict__)
+        return self.clauses[expr.source]
+
+    def compile_picker(self, filters, name):
         if not filters:
             return self.picker(name)
         elif isinstance(filters[0], list):
@@ -242,49 +898,191 @@ class DB:
                 picker.add(self.picker_from_filters(f), freq)
             return picker
 
-        filters = [eval(s, None, Picture.__dict__) for s in filters]
-        return self.picker(name, *filters)
+        expressions = [Expression(s) for s in filters]
+        filters = [self.clause(e) for e in expressions]
+        return self.picker(name, *filters, expressions=expressions)
 
-    def picker(self, name='&All', *filters):
-        return ListPicker(name, self, *filters)
+    def picker(self, name='&All', *filters, predicate=None, expressions=None):
+        picker = ListPicker(name, self, *filters, predicate=predicate, expressions=expressions)
+        self.list_pickers.add(picker)
+        return picker
 
     def get_remote(self):
-        ret = run(['rsync', '-a', '--info=stats2', '--delete',
-                   self.remote, Picture.root + sep], stdout=PIPE)
-        self.update_session()
-        return ret.stdout.decode()
+        def finish():
+            self.release()
+            self.store.install()
+            self.create_indexes()
+            self.update_session()
+            self.invalidate()
+        self.release()
+        return Transfer(lambda t: pull(t, self.Picture.root, self.remote), finish)
 
     def put_remote(self):
         self.session.commit()
-        ret = run(['rsync', '-a', '--info=stats2', '--delete',
-                   Picture.root + sep, self.remote], stdout=PIPE)
-        self.update_session()
-        return ret.stdout.decode()
+        self.store.commit()
+        self.release()
+        return Transfer(lambda t: push(t, self.Picture.root, self.remote), self.update_session)
 
     def mark_delete(self, pic):
         if pic.id:
             pic.delt = True
             self.session.commit()
+            self.updated(pic)
+            self.store.commit()
 
     def get_delete_ids(self):
-        return {p.id for p in self.query().filter(Picture.delt == True)}
+        return {p.id for p in self.query().filter(self.Picture.delt == True)}
+
+    def get_pictures(self, ids):
+        return self.query().filter(self.Picture.id.in_(ids))
 
-    def delete(self, pic):
-        run(['rm', pic.filename])
+    def journal(self):
+        return Journal(join(self.Picture.root, '.journal'))
+
+    def commit(self, journal):
+        journal.write()
+        self.session.commit()
+        self.store.commit()
+        journal.apply()
+
+    def replay(self):
+        journal = self.journal()
+        if journal.load():
+            ids = journal.ids()
+            existing = {idx for idx, in self.session.query(self.Picture.id).filter(self.Picture.id.in_(ids))}
+            journal.apply(existing)
+
+    def delete(self, pic, journal):
+        journal.unlink(pic.filename, pic.id)
         self.session.delete(pic)
+        self.session.execute(self.hashes.delete().where(self.hashes.c.id == pic.id))
+        self.generation += 1
+        self.store.remove([pic.id])
+        for picker in self.list_pickers:
+            picker.remove(pic.id, pic)
+        self.renditions.discard(pic.id)
+
+    def staged(self):
+        return [join(self.staging, fn) for fn in listdir(self.staging) if not fn.startswith('.')]
+
+    def fingerprints(self):
+        h = self.hashes
+        return self.session.execute(
+            select([h.c.id, h.c.sha, h.c.dhash]).select_from(h.join(self.table, h.c.id == self.table.c.id))
+        ).fetchall()
+
+    def unhashed(self, limit):
+        return self.query().outerjoin(self.hashes, self.Picture.id == self.hashes.c.id).filter(
+            self.hashes.c.id == None
+        ).limit(limit).all()
+
+    def picture_key(self, pic):
+        return pic.id
+
+    def describe(self, key):
+        return str(key)
+
+    def store_fingerprints(self, rows):
+        if rows:
+            self.session.execute(self.hashes.insert().prefix_with('OR REPLACE'), rows)
+
+    def scan(self, snapshot, path):
+        mtime = stat(path).st_mtime_ns
+        cached = snapshot.get(path)
+        if cached and len(cached) == 3 and cached[0] == mtime:
+            return cached[1], cached[2]
+        names, dirs = [], []
+        for e in scandir(path):
+            if e.name == 'plib.db' or not tracked(e.name):
+                continue
+            if e.is_dir():
+                if e.name.isdigit():
+                    dirs.append(e.name)
+            elif e.is_file():
+                names.append(e.name)
+        snapshot[path] = (mtime, names, dirs)
+        return names, dirs
+
+    def listing(self, snapshot):
+        names, dirs = self.scan(snapshot, self.Picture.root)
+        for name in names:
+            yield '', name
+        for d in dirs:
+            names, _ = self.scan(snapshot, join(self.Picture.root, d))
+            for name in names:
+                yield d, name
+
+    def extensions(self):
+        cols = self.store.columns
+        return dict(zip(cols['id'].tolist(), cols['extension'].tolist()))
+
+    def misplaced(self):
+        existing_db = self.extensions()
+        for d, name in self.listing({}):
+            idx = name.partition('.')[0]
+            if not idx.isdigit() or int(idx) not in existing_db:
+                continue
+            idx = int(idx)
+            if name == self.Picture.basename(idx, existing_db[idx]) and d != self.Picture.directory(idx):
+                yield idx, join(d, name), self.Picture.relpath(idx, existing_db[idx])
+
+    def reshard(self, batch=1000):
+        pending = self.misplaced()
+        while True:
+            chunk = list(islice(pending, batch))
+            if not chunk:
+                break
+            journal = self.journal()
+            for idx, src, dst in chunk:
+                journal.rename(join(self.Picture.root, src), join(self.Picture.root, dst), idx)
+            journal.write()
+            journal.apply()
+            yield len(chunk)
 
     def sync_local(self):
-        existing_db = {p.filename for p in self.query()}
-        existing_hd = {join(Picture.root, fn) for fn in listdir(Picture.root) if fn != 'plib.db'}
-        existing_hd = {fn for fn in existing_hd if isfile(fn)}
+        snapshot_path = join(self.Picture.root, '.scan')
+        try:
+            with open(snapshot_path, 'rb') as f:
+                snapshot = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            snapshot = {}
+
+        existing_db = self.extensions()
+        wanted = {idx: self.Picture.basename(idx, ext) for idx, ext in existing_db.items()}
+        existing_hd, extra = {}, []
+        for d, name in self.listing(snapshot):
+            idx = name.partition('.')[0]
+            key = int(idx) if idx.isdigit() else join(d, name)
+            if key in existing_hd:
+                if name == wanted.get(key) and d == self.Picture.directory(key):
+                    (d, name), existing_hd[key] = existing_hd[key], (d, name)
+                extra.append((d, name))
+            else:
+                existing_hd[key] = (d, name)
 
-        delete_ids = {int(basename(f).split('.')[-2]) for f in existing_db - existing_hd}
+        delete_ids = {idx for idx, name in wanted.items()
+                      if existing_hd.get(idx, (None, None))[1] != name}
         if delete_ids:
-            self.query().filter(Picture.id.in_(delete_ids)).delete(synchronize_session='fetch')
+            self.query().filter(self.Picture.id.in_(delete_ids)).delete(synchronize_session='fetch')
+            self.session.execute(self.hashes.delete().where(self.hashes.c.id.in_(delete_ids)))
+            self.removed(*delete_ids)
+            self.renditions.discard(*delete_ids)
+
+        move_files = extra + [loc for idx, loc in existing_hd.items() if loc[1] != wanted.get(idx)]
+        journal = self.journal()
+        for d, name in move_files:
+            journal.rename(join(self.Picture.root, d, name), join(self.staging, name))
+        for idx, (d, name) in existing_hd.items():
+            if idx in wanted and idx not in delete_ids and d != self.Picture.directory(idx):
+                journal.rename(join(self.Picture.root, d, name), join(self.Picture.root, self.Picture.relpath(idx, existing_db[idx])), idx)
+        if journal:
+            for op in journal.ops:
+                for fn in op[2:]:
+                    snapshot.pop(dirname(fn), None)
+            journal.write()
+            journal.apply()
 
-        move_files = existing_hd - existing_db
-        for fn in move_files:
-            run(['mv', fn, join(self.staging, basename(fn))])
+        with open(snapshot_path, 'wb') as f:
+            pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
 
-        return (len(delete_ids), len(move_files),
-                [join(self.staging, fn) for fn in listdir(self.staging)])
+        return len(delete_ids), len(move_files), self.staged()
@@ -0,0 +1,132 @@
+from functools import lru_cache, reduce
+import ast
+
+
+@lru_cache(maxsize=None)
+def vector_globals():
+    import numpy as np
+
+    return {
+        'abs': np.absolute,
+        'int': lambda a: np.asarray(a).astype(int),
+        'float': lambda a: np.asarray(a).astype(float),
+        'bool': lambda a: np.asarray(a).astype(bool),
+        'max': lambda *a: reduce(np.maximum, a),
+        'min': lambda *a: reduce(np.minimum, a),
+        'round': np.round,
+        '_np': np,
+        '__builtins__': {},
+    }
+
+
+def _np_call(func, *args):
+    return ast.Call(
+        func=ast.Attribute(value=ast.Name(id='_np', ctx=ast.Load()), attr=func, ctx=ast.Load()),
+        args=list(args), keywords=[],
+    )
+
+
+class Unvectorizable(Exception):
+    pass
+
+
+def boolean(node):
+    if isinstance(node, (ast.Compare, ast.BoolOp)):
+        return True
+    if isinstance(node, ast.UnaryOp):
+        return isinstance(node.op, ast.Not)
+    if isinstance(node, ast.Constant):
+        return isinstance(node.value, bool)
+    return isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == 'bool'
+
+
+class Vectorizer(ast.NodeTransformer):
+
+    def visit_BoolOp(self, node):
+        if not all(boolean(value) for value in node.values):
+            raise Unvectorizable(node)
+        self.generic_visit(node)
+        func = 'logical_and' if isinstance(node.op, ast.And) else 'logical_or'
+        expr = node.values[0]
+        for value in node.values[1:]:
+            expr = _np_call(func, expr, value)
+        return expr
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Not):
+            return _np_call('logical_not', node.operand)
+        return node
+
+    def visit_IfExp(self, node):
+        self.generic_visit(node)
+        return _np_call('where', node.test, node.body, node.orelse)
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        if len(node.ops) == 1:
+            op, right = node.ops[0], node.comparators[0]
+            if not isinstance(op, (ast.In, ast.NotIn)):
+                return node
+            if not isinstance(right, (ast.Tuple, ast.List, ast.Set)):
+                raise Unvectorizable(node)
+            right = ast.List(elts=right.elts, ctx=ast.Load())
+            isin = _np_call('isin', node.left, right)
+            return isin if isinstance(op, ast.In) else _np_call('logical_not', isin)
+        left, terms = node.left, []
+        for op, right in zip(node.ops, node.comparators):
+            terms.append(ast.Compare(left=left, ops=[op], comparators=[right]))
+            left = right
+        return self.visit_BoolOp(ast.BoolOp(op=ast.And(), values=terms))
+
+
+INEXACT = (ast.Div, ast.FloorDiv, ast.Mod, ast.Pow, ast.Call)
+
+
+COMPILED = {}
+
+
+def compile_expression(source):
+    tree = ast.parse(source, mode='eval')
+    names = frozenset(n.id for n in ast.walk(tree) if isinstance(n, ast.Name))
+    exact = not any(isinstance(n, INEXACT) for n in ast.walk(tree))
+    code = compile(tree, '<expression>', 'eval')
+    try:
+        vector = ast.fix_missing_locations(Vectorizer().visit(ast.parse(source, mode='eval')))
+        vector = compile(vector, '<expression>', 'eval')
+    except Unvectorizable:
+        vector, exact = None, False
+    return names, exact, code, vector
+
+
+class Expression:
+
+    def __init__(self, source):
+        self.source = str(source)
+        if self.source not in COMPILED:
+            COMPILED[self.source] = compile_expression(self.source)
+        names, self.exact, self.code, self.vector_code = COMPILED[self.source]
+        self.names = set(names)
+
+    def __repr__(self):
+        return 'Expression({!r})'.format(self.source)
+
+    def __call__(self, pic):
+        return eval(self.code, None, pic.__dict__)
+
+    def scalar(self, columns, length):
+        keys = list(columns)
+        if not keys:
+            return [eval(self.code, None, {})] * length
+        values = zip(*(columns[k].tolist() for k in keys))
+        return [eval(self.code, None, dict(zip(keys, row))) for row in values]
+
+    def vector(self, columns, length):
+        env = vector_globals()
+        try:
+            if self.vector_code is None:
+                raise Unvectorizable(self.source)
+            result = eval(self.vector_code, env, columns)
+        except Exception:
+            result = env['_np'].array(self.scalar(columns, length))
+        return env['_np'].broadcast_to(result, (length,))
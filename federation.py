@@ -0,0 +1,182 @@
+from concurrent.futures import ThreadPoolExecutor
+from shutil import disk_usage
+
+from db import DB, Status, UnionPicker
+from sync import Transfers
+
+
+class FederatedPicker(UnionPicker):
+
+    def __init__(self, name, pool):
+        super(FederatedPicker, self).__init__(name)
+        self.pool = pool
+
+    @staticmethod
+    def size(picker):
+        return sum(len(leaf.index) for leaf in picker.leaves())
+
+    def flatten(self, weight=1.0):
+        pickers = [p for p, _ in self.pickers]
+        sizes = list(self.pool.map(self.size, pickers))
+        total = sum(sizes)
+        for p, n in zip(pickers, sizes):
+            if n:
+                yield from p.flatten(weight * n / total)
+
+    def split(self, predicate):
+        true, false = FederatedPicker(self.name, self.pool), FederatedPicker(self.name, self.pool)
+        for picker, _ in self.pickers:
+            t, f = picker.split(predicate)
+            true.add(t)
+            false.add(f)
+        return true, false
+
+
+class Federation:
+
+    def __init__(self, config):
+        pics = {k: v for k, v in config['pics'].items() if k != 'libraries'}
+        self.shards = []
+        for i, library in enumerate(config['pics']['libraries']):
+            shard = dict(config, pics=dict(pics, **library))
+            self.shards.append(DB(shard, label=str(library.get('name', i))))
+        self.pool = ThreadPoolExecutor(len(self.shards))
+        self.journals = {}
+        self.select_target()
+
+        first = self.shards[0]
+        self.custom_columns = first.custom_columns
+        self.shuffle = first.shuffle
+        self.ingest = first.ingest
+
+        self.compiled = {}
+        self.pickers = [('&All', self.picker_from_filters())]
+        for p in config['pickers']:
+            name, filters = next(iter(p.items()))
+            self.pickers.append((name, self.picker_from_filters(filters, name)))
+
+        self.status = Status(self, config['status'])
+        for shard in self.shards:
+            shard.status = self.status
+            shard.create_indexes()
+
+    def select_target(self):
+        self.target = max(self.shards, key=lambda s: disk_usage(s.Picture.root).free)
+
+    def map(self, func):
+        return list(self.pool.map(func, self.shards))
+
+    @property
+    def Picture(self):
+        return self.target.Picture
+
+    @property
+    def session(self):
+        return self.target.session
+
+    @property
+    def renditions(self):
+        return self.target.renditions
+
+    @property
+    def generation(self):
+        return sum(shard.generation for shard in self.shards)
+
+    def invalidate(self):
+        for shard in self.shards:
+            shard.invalidate()
+
+    def updated(self, *pics):
+        for pic in pics:
+            pic.db.updated(pic)
+
+    def picker_from_filters(self, filters=[], name='&All'):
+        key = repr(filters)
+        if key not in self.compiled:
+            self.compiled[key] = self.compile_picker(filters, name)
+        return self.compiled[key]
+
+    def compile_picker(self, filters, name):
+        if filters and isinstance(filters[0], list):
+            picker = UnionPicker(name)
+            for f in filters:
+                freq = 1.0
+                if f and isinstance(f[0], float):
+                    freq = f[0]
+                    f = f[1:]
+                picker.add(self.picker_from_filters(f), freq)
+            return picker
+
+        picker = FederatedPicker(name, self.pool)
+        for shard in self.shards:
+            picker.add(shard.picker_from_filters(filters, name))
+        return picker
+
+    def picker(self, name='&All'):
+        return self.picker_from_filters([], name)
+
+    def get_remote(self):
+        return Transfers([shard.get_remote() for shard in self.shards])
+
+    def put_remote(self):
+        transfers = Transfers([shard.put_remote() for shard in self.shards])
+        self.select_target()
+        return transfers
+
+    def mark_delete(self, pic):
+        pic.db.mark_delete(pic)
+
+    def get_delete_ids(self):
+        return {(i, idx) for i, shard in enumerate(self.shards) for idx in shard.get_delete_ids()}
+
+    def get_pictures(self, ids):
+        for i, shard in enumerate(self.shards):
+            wanted = [idx for j, idx in ids if j == i]
+            if wanted:
+                yield from shard.get_pictures(wanted)
+
+    def journal(self):
+        return self.target.journal()
+
+    def delete(self, pic, journal):
+        shard = pic.db
+        if shard is not self.target:
+            journal = self.journals.setdefault(shard, shard.journal())
+        shard.delete(pic, journal)
+
+    def commit(self, journal):
+        journals, self.journals = self.journals, {}
+        for shard in self.shards:
+            if shard is self.target:
+                shard.commit(journal)
+            elif shard in journals:
+                shard.commit(journals[shard])
+            else:
+                shard.session.commit()
+                shard.store.commit()
+
+    def staged(self):
+        staging = {shard.staging: shard for shard in self.shards}
+        return [fn for shard in staging.values() for fn in shard.staged()]
+
+    def fingerprints(self):
+        rows = self.map(lambda s: [((s.label, idx), sha, dh) for idx, sha, dh in s.fingerprints()])
+        return [row for shard in rows for row in shard]
+
+    def picture_key(self, pic):
+        return pic.db.label, pic.id
+
+    def describe(self, key):
+        if isinstance(key, str):
+            return key
+        return '{1} in {0}'.format(*key)
+
+    def unhashed(self, limit):
+        return self.target.unhashed(limit)
+
+    def store_fingerprints(self, rows):
+        self.target.store_fingerprints(rows)
+
+    def sync_local(self):
+        results = self.map(lambda s: s.sync_local())
+        return sum(r[0] for r in results), sum(r[1] for r in results), self.staged()
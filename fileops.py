@@ -0,0 +1,73 @@
+from errno import EXDEV
+from os import fsync, makedirs, remove, replace
+from os.path import dirname, exists
+from shutil import move
+import json
+
+
+class Journal:
+
+    def __init__(self, path):
+        self.path = path
+        self.ops = []
+
+    def __len__(self):
+        return len(self.ops)
+
+    def rename(self, src, dst, idx=None):
+        self.ops.append(['rename', idx, src, dst])
+
+    def unlink(self, fn, idx=None):
+        self.ops.append(['unlink', idx, fn])
+
+    def load(self):
+        if not exists(self.path):
+            return False
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    self.ops.append(json.loads(line))
+                except ValueError:
+                    break
+        return True
+
+    def ids(self):
+        return {op[1] for op in self.ops if op[1] is not None}
+
+    def write(self):
+        with open(self.path, 'w') as f:
+            for op in self.ops:
+                f.write(json.dumps(op) + '\n')
+            f.flush()
+            fsync(f.fileno())
+
+    def apply(self, existing=None):
+        for op, idx, *args in self.ops:
+            if op == 'rename':
+                if existing is None or idx is None or idx in existing:
+                    self.move(*args)
+            elif op == 'unlink':
+                if existing is None or idx is None or idx not in existing:
+                    self.remove(*args)
+        self.ops = []
+        if exists(self.path):
+            remove(self.path)
+
+    @staticmethod
+    def move(src, dst):
+        if not exists(src):
+            return
+        makedirs(dirname(dst), exist_ok=True)
+        try:
+            replace(src, dst)
+        except OSError as e:
+            if e.errno != EXDEV:
+                raise
+            move(src, dst)
+
+    @staticmethod
+    def remove(fn):
+        try:
+            remove(fn)
+        except FileNotFoundError:
+            pass
@@ -3,18 +3,24 @@ from PyQt5.QtCore import Qt, QTimer
 from PyQt5.QtGui import QPixmap
 from PyQt5.QtWidgets import QApplication, QDialog, QMainWindow, QMessageBox
 
-from gui_utils import ImageView, FlagsDialog, MessageDialog, PickerDialog
-from programs import ShowProgram, InfoProgram
+from gui_utils import ImageCache, ImageView, FlagsDialog, MessageDialog, PickerDialog
+from programs import AbstractProgram, ShowProgram, InfoProgram
+from timing import Tracer, log, phase, since_start
 
 
 class MainWindow(QMainWindow):
 
-    def __init__(self, db):
+    def __init__(self, db, config):
         super(MainWindow, self).__init__()
         self.setWindowTitle('PTools')
         self.db = db
 
-        image = ImageView()
+        self.prefetch = int(config.get('prefetch', 4))
+        self.screen = QApplication.primaryScreen().size()
+        self.cache = ImageCache(self.source, budget=int(config.get('cache_mb', 256)),
+                                size=(self.screen.width(), self.screen.height()))
+
+        image = ImageView(self.cache)
         self.setCentralWidget(image)
         self.image = image
         self.black = False
@@ -25,6 +31,9 @@ class MainWindow(QMainWindow):
         self.programs = []
         ShowProgram(self)
 
+        if self.st.pull is not None:
+            self.start_timer(100, self.poll_status)
+
     @property
     def st(self):
         return self.db.status
@@ -47,6 +56,26 @@ class MainWindow(QMainWindow):
     def show_image(self, pic):
         self.current_pic = pic
         self.image.load(pic)
+        if self.prefetch and self.programs:
+            QTimer.singleShot(0, self.prefetch_upcoming)
+
+    def prefetch_upcoming(self):
+        if self.programs:
+            self.cache.prefetch(self.programs[-1].upcoming(self, self.prefetch))
+
+    def poll_status(self, m, timer):
+        if self.st.pull.poll():
+            timer.stop()
+            log.info('status pull finished after %.1f ms', since_start())
+
+    def source(self, pic):
+        if isinstance(pic, str):
+            return pic
+        return pic.db.renditions.path(pic, self.screen.width(), self.screen.height())
+
+    def show_status(self, text):
+        self.statusBar().setVisible(bool(text))
+        self.statusBar().showMessage(text)
 
     def show_message(self, msg, align='center'):
         if isinstance(msg, str):
@@ -89,11 +118,47 @@ class MainWindow(QMainWindow):
         self.programs[-1].key(self, event)
 
 
-def run_gui(db, msg=None):
-    app = QApplication(sys.argv)
-    win = MainWindow(db)
-    win.showMaximized()
+def subclasses(cls):
+    for sub in cls.__subclasses__():
+        yield sub
+        yield from subclasses(sub)
+
+
+def instrument(path):
+    from db import ListPicker, Picker, UnionPicker
+    from expressions import Expression
+    from gui_utils import ImageCache
+    from renditions import RenditionCache
+
+    tracer = Tracer(path)
+    tracer.instrument(MainWindow, 'keyPressEvent', 'show_image')
+    tracer.instrument(ImageView, 'load', 'resize')
+    tracer.instrument(ImageCache, 'decode', 'get')
+    tracer.instrument(RenditionCache, 'path')
+    tracer.instrument(Picker, 'get', 'peek')
+    tracer.instrument(ListPicker, 'draw', 'probe')
+    tracer.instrument(UnionPicker, 'leaf')
+    tracer.instrument(Expression, '__call__')
+    for cls in subclasses(AbstractProgram):
+        tracer.instrument(cls, 'key', 'next')
+    return tracer
+
+
+def run_gui(db, config, msg=None):
+    tracer = None
+    if config.get('trace'):
+        path = config['trace'] if isinstance(config['trace'], str) else 'ptools-trace.json'
+        tracer = instrument(path)
+    with phase('qt'):
+        app = QApplication(sys.argv)
+    with phase('window'):
+        win = MainWindow(db, config)
+        win.showMaximized()
+    QTimer.singleShot(0, lambda: log.info('first frame after %.1f ms', since_start()))
     if msg:
         print(msg)
         win.show_message(msg)
-    return app.exec_()
+    retval = app.exec_()
+    if tracer:
+        tracer.close()
+    return retval
@@ -1,8 +1,11 @@
 import sys
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import RLock
 from sqlalchemy import Boolean, Integer
 
 from PyQt5.QtCore import Qt
-from PyQt5.QtGui import QFont, QPixmap
+from PyQt5.QtGui import QFont, QImageReader, QPixmap
 from PyQt5.QtWidgets import (
     QCheckBox, QDialog, QGridLayout, QHBoxLayout, QLabel, QLayout, QMainWindow,
     QPushButton, QSizePolicy, QSlider, QSpinBox, QVBoxLayout, QWidget
@@ -10,25 +13,82 @@ from PyQt5.QtWidgets import (
 
 from db import UnionPicker
 
+
+def image_filename(pic):
+    return pic if isinstance(pic, str) else pic.filename
+
+
+def read_image(fn, width=None, height=None):
+    reader = QImageReader(fn)
+    size = reader.size()
+    if width and size.isValid() and (size.width() > width or size.height() > height):
+        reader.setScaledSize(size.scaled(width, height, Qt.KeepAspectRatio))
+    return reader.read()
+
+
+class ImageCache:
+
+    def __init__(self, source=image_filename, budget=256, workers=1, size=(None, None)):
+        self.source = source
+        self.size = size
+        self.budget = budget * 1024 * 1024
+        self.images = OrderedDict()
+        self.lock = RLock()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def decode(self, pic):
+        return read_image(self.source(pic), *self.size)
+
+    def prefetch(self, pics):
+        with self.lock:
+            for pic in pics:
+                fn = image_filename(pic)
+                if fn in self.images:
+                    self.images.move_to_end(fn)
+                else:
+                    future = self.executor.submit(self.decode, pic)
+                    future.add_done_callback(lambda _: self.evict())
+                    self.images[fn] = future
+
+    def get(self, pic):
+        fn = image_filename(pic)
+        with self.lock:
+            future = self.images.get(fn)
+            if future is not None:
+                self.images.move_to_end(fn)
+        if future is None:
+            return self.decode(pic)
+        return future.result()
+
+    def evict(self):
+        with self.lock:
+            for fn in [fn for fn, f in self.images.items() if f.done() and f.exception() is not None]:
+                del self.images[fn]
+            done = [(fn, f.result().byteCount()) for fn, f in self.images.items() if f.done()]
+            total = sum(size for _, size in done)
+            for fn, size in done:
+                if total <= self.budget:
+                    break
+                del self.images[fn]
+                total -= size
+
+
 class ImageView(QLabel):
 
-    def __init__(self):
+    def __init__(self, cache):
         super(ImageView, self).__init__()
         self.setMinimumSize(1,1)
         self.setAlignment(Qt.Alignment(0x84))
         self.setStyleSheet('QLabel { background-color: black; }')
 
+        self.cache = cache
         self.orig_pixmap = None
 
     def load(self, pic):
         if not pic:
             self.orig_pixmap = QPixmap()
         else:
-            if isinstance(pic, str):
-                fn = pic
-            else:
-                fn = pic.filename
-            self.orig_pixmap = QPixmap(fn)
+            self.orig_pixmap = QPixmap.fromImage(self.cache.get(pic))
         self.resize()
 
     def resize(self):
@@ -64,7 +124,7 @@ class ButtonsWidget(QWidget):
 
 class PickerWidget(QWidget):
 
-    def __init__(self, picker):
+    def __init__(self, name, picker):
         super(PickerWidget, self).__init__()
 
         self.picker = picker
@@ -72,7 +132,7 @@ class PickerWidget(QWidget):
         layout = QHBoxLayout()
         self.setLayout(layout)
 
-        checkbox = QCheckBox(picker.name)
+        checkbox = QCheckBox(name)
         checkbox.setSizePolicy(QSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed))
         checkbox.setMinimumWidth(100)
         checkbox.stateChanged.connect(self.check)
@@ -157,7 +217,7 @@ class PickerDialog(QDialog):
         super(PickerDialog, self).__init__()
         self.setWindowTitle('Pickers')
         self.db = db
-        self.widgets = [PickerWidget(p) for p in db.pickers]
+        self.widgets = [PickerWidget(name, p) for name, p in db.pickers]
 
         layout = QVBoxLayout()
         self.setLayout(layout)
@@ -0,0 +1,136 @@
+from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QImage, qGray
+
+from sync import hash_file
+
+
+def dhash(fn):
+    image = QImage(fn)
+    if image.isNull():
+        return None
+    small = image.scaled(9, 8, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+    bits = 0
+    for y in range(8):
+        for x in range(8):
+            bits = bits << 1 | (qGray(small.pixel(x, y)) > qGray(small.pixel(x + 1, y)))
+    return bits - (1 << 64) if bits >= 1 << 63 else bits
+
+
+def fingerprint(fn):
+    return hash_file(fn), dhash(fn)
+
+
+class Ingest:
+
+    def __init__(self, db, files, distance=4, backfill=2000):
+        self.db = db
+        self.distance = distance
+        self.pool = db.renditions.pool
+        self.futures = {}
+        self.collected = []
+        self.accepted = []
+        self.shas = {}
+        self.keys = []
+        self.dhashes = []
+        self._array = None
+
+        for idx, sha, dh in db.fingerprints():
+            self.remember(idx, sha, dh)
+        self.add(files)
+        self.backfill = {pic.id: (db.picture_key(pic), self.pool.submit(fingerprint, pic.filename))
+                         for pic in db.unhashed(backfill)}
+
+    def add(self, files):
+        for fn in files:
+            if fn not in self.futures:
+                self.futures[fn] = self.pool.submit(fingerprint, fn)
+
+    def remember(self, key, sha, dh):
+        self.shas.setdefault(sha, key)
+        if dh is not None:
+            self.keys.append(key)
+            self.dhashes.append(dh)
+            self._array = None
+
+    def ready(self, fn):
+        future = self.futures.get(fn)
+        return future is None or future.done()
+
+    def result(self, fn, wait=True):
+        future = self.futures.get(fn)
+        if future is None or not (wait or future.done()):
+            return None
+        try:
+            return future.result()
+        except OSError:
+            return None
+
+    def collect(self):
+        for idx, (key, future) in list(self.backfill.items()):
+            if not future.done():
+                continue
+            del self.backfill[idx]
+            try:
+                sha, dh = future.result()
+            except OSError:
+                continue
+            self.remember(key, sha, dh)
+            self.collected.append({'id': idx, 'sha': sha, 'dhash': dh})
+        for fn in [fn for fn in self.accepted if self.ready(fn)]:
+            self.accepted.remove(fn)
+            self.remember_file(fn)
+
+    def remember_file(self, fn):
+        result = self.result(fn)
+        if result is not None:
+            self.remember(fn, *result)
+
+    def nearest(self, dh):
+        import numpy as np
+
+        if not self.dhashes:
+            return None
+        if self._array is None:
+            self._array = np.array(self.dhashes, dtype=np.int64)
+        diff = np.bitwise_xor(self._array, np.int64(dh)).view(np.uint8).reshape(-1, 8)
+        dist = np.unpackbits(diff, axis=1).sum(axis=1)
+        best = int(np.argmin(dist))
+        return self.keys[best] if dist[best] <= self.distance else None
+
+    def duplicate(self, fn, wait=True):
+        self.collect()
+        result = self.result(fn, wait)
+        if result is None:
+            return None
+        sha, dh = result
+        if self.shas.get(sha, fn) != fn:
+            return self.shas[sha]
+        if dh is not None:
+            match = self.nearest(dh)
+            if match != fn:
+                return match
+
+    def accept(self, fn):
+        self.accepted.append(fn)
+
+    def rows(self, moves):
+        self.collect()
+        rows, self.collected = self.collected, []
+        for fn in [fn for fn in self.accepted if fn in moves]:
+            self.accepted.remove(fn)
+            self.remember_file(fn)
+        for fn, pic in moves.items():
+            result = self.result(fn)
+            if result is None:
+                continue
+            sha, dh = result
+            rows.append({'id': pic.id, 'sha': sha, 'dhash': dh})
+            if self.shas.get(sha) == fn:
+                self.shas[sha] = self.db.picture_key(pic)
+        ids = {fn: self.db.picture_key(pic) for fn, pic in moves.items()}
+        self.keys = [ids.get(k, k) if isinstance(k, str) else k for k in self.keys]
+        return rows
+
+    def cancel(self):
+        for _, future in self.backfill.values():
+            future.cancel()
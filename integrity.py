@@ -0,0 +1,179 @@
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from multiprocessing import get_context
+from os import cpu_count, getpid, nice, replace
+from os.path import exists, getsize, join
+from subprocess import DEVNULL, run
+from time import monotonic, sleep
+import json
+import sqlite3
+
+from PyQt5.QtCore import QSize
+from PyQt5.QtGui import QImageReader
+
+
+MAGIC = [
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'BM', 'bmp'),
+    (b'II*\x00', 'tif'),
+    (b'MM\x00*', 'tif'),
+]
+
+TRAILERS = {
+    'jpg': b'\xff\xd9',
+    'png': b'IEND\xaeB`\x82',
+}
+
+ALIASES = {'jpeg': 'jpg', 'tiff': 'tif'}
+
+
+def kind(head):
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    for magic, ext in MAGIC:
+        if head.startswith(magic):
+            return ext
+
+
+def lower_priority():
+    nice(10)
+    try:
+        run(['ionice', '-c', '3', '-p', str(getpid())], stdout=DEVNULL, stderr=DEVNULL)
+    except OSError:
+        pass
+
+
+def check(fn, ext, size):
+    if not exists(fn):
+        return ['missing'], 0
+    problems = []
+    actual = getsize(fn)
+    if size is not None and actual != size:
+        problems.append('size {} differs from manifest {}'.format(actual, size))
+
+    ext = ALIASES.get(ext.lower(), ext.lower())
+    with open(fn, 'rb') as f:
+        head = f.read(16)
+        f.seek(max(0, actual - 4096))
+        tail = f.read()
+    content = kind(head)
+    if content is None:
+        problems.append('unknown format')
+    elif content != ext:
+        problems.append('content is {} but extension is {}'.format(content, ext))
+    if content in TRAILERS and TRAILERS[content] not in tail:
+        problems.append('truncated')
+
+    reader = QImageReader(fn)
+    dims = reader.size()
+    if dims.isValid():
+        reader.setScaledSize(QSize(max(1, dims.width() // 8), max(1, dims.height() // 8)))
+    if reader.read().isNull():
+        problems.append('decode failed: {}'.format(reader.errorString()))
+    return problems, actual
+
+
+def manifest_sizes(root):
+    path = join(root, '.manifest.db')
+    if not exists(path):
+        return {}
+    conn = sqlite3.connect(path)
+    try:
+        return dict(conn.execute('SELECT name, size FROM entries'))
+    finally:
+        conn.close()
+
+
+class Scan:
+
+    def __init__(self, checkpoint):
+        self.checkpoint = checkpoint
+        self.state = {'started': datetime.now().isoformat(), 'last_id': -1,
+                      'checked': 0, 'bytes': 0, 'problems': {}}
+        if exists(checkpoint):
+            with open(checkpoint, 'r') as f:
+                self.state = json.load(f)
+
+    def save(self):
+        tmp = self.checkpoint + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f)
+        replace(tmp, self.checkpoint)
+
+    def record(self, idx, name, problems, size):
+        self.state['last_id'] = idx
+        self.state['checked'] += 1
+        self.state['bytes'] += size
+        if problems:
+            self.state['problems'][name] = {'id': idx, 'problems': problems}
+
+    def report(self, path):
+        report = dict(self.state, finished=datetime.now().isoformat())
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+def scan(db, checkpoint, report, workers=None, rate=50.0, batch=256, restart=False):
+    Picture = db.Picture
+    if restart and exists(checkpoint):
+        replace(checkpoint, checkpoint + '.old')
+    state = Scan(checkpoint)
+    sizes = manifest_sizes(Picture.root)
+    cols = db.store.columns
+    ids, exts = cols['id'], cols['extension']
+    start = int((ids <= state.state['last_id']).sum())
+    limit = rate * 1024 * 1024
+    pool = ProcessPoolExecutor(workers or cpu_count(), mp_context=get_context('spawn'),
+                               initializer=lower_priority)
+
+    began, done = monotonic(), 0
+    for offset in range(start, len(ids), batch):
+        chunk = [(int(idx), str(ext)) for idx, ext in zip(ids[offset:offset+batch], exts[offset:offset+batch])]
+        names = [Picture.relpath(idx, ext) for idx, ext in chunk]
+        results = pool.map(check, [join(Picture.root, n) for n in names], [ext for _, ext in chunk],
+                           [sizes.get(n) for n in names], chunksize=8)
+        for (idx, _), name, (problems, size) in zip(chunk, names, results):
+            state.record(idx, name, problems, size)
+            done += size
+        state.save()
+        print('Checked {} of {}, {} problems'.format(state.state['checked'], len(ids),
+                                                      len(state.state['problems'])))
+        if limit:
+            ahead = done / limit - (monotonic() - began)
+            if ahead > 0:
+                sleep(ahead)
+
+    pool.shutdown()
+    state.report(report)
+    if exists(checkpoint):
+        replace(checkpoint, checkpoint + '.done')
+    return state.state['problems']
+
+
+if __name__ == '__main__':
+    from compiled import load_yaml
+    from db import DB
+    from federation import Federation
+
+    parser = ArgumentParser(description='Check every picture in the library for corruption')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--rate', type=float, default=50.0, help='MB/s, 0 for unlimited')
+    parser.add_argument('--report', default='integrity-report.json')
+    parser.add_argument('--restart', action='store_true')
+    args = parser.parse_args()
+
+    with open('config.yaml', 'r') as f:
+        config = load_yaml(f)
+    if config['db']['pics'].get('libraries'):
+        shards = Federation(config['db']).shards
+    else:
+        shards = [DB(config['db'])]
+    for db in shards:
+        report = args.report if len(shards) == 1 else '{}.{}'.format(db.label, args.report)
+        problems = scan(db, join(db.Picture.root, '.integrity'), report,
+                        workers=args.workers, rate=args.rate, restart=args.restart)
+        print('{} pictures with problems in {}, see {}'.format(len(problems), db.Picture.root, report))
@@ -1,16 +1,57 @@
 from datetime import datetime, date, timedelta
-from itertools import groupby
+from functools import lru_cache
 from math import ceil, sqrt
-from os.path import join
+from os.path import basename, dirname, join
 from random import random, choice
 from string import ascii_lowercase
-from subprocess import run
-import re
-import numpy as np
+from threading import Thread
 
 from PyQt5.QtCore import Qt
 
-from db import Picture, UnionPicker
+from db import UnionPicker
+from fileops import Journal
+from ingest import Ingest
+
+
+@lru_cache(maxsize=64)
+def solve_num_our(hist_our, hist_you, num_you, prob, max_num_our=1<<24, block=256):
+    import numpy as np
+
+    values, counts = np.array(hist_our).T
+    log_cdf = np.log(np.cumsum(counts) / counts.sum())
+    log_prev = np.concatenate([[-np.inf], log_cdf[:-1]])
+
+    you_values, you_counts = np.array(hist_you).T
+    you_cdf = np.cumsum(you_counts) / you_counts.sum()
+    you_at = np.searchsorted(you_values, values, side='right')
+    you_cdf = np.concatenate([[0.0], you_cdf])[you_at]
+    you_lose = -np.expm1(num_you * np.log(np.maximum(you_cdf, np.finfo(float).tiny)))
+    you_lose[you_cdf == 0.0] = 1.0
+
+    def prob_you(num_our):
+        num_our = np.asarray(num_our, dtype=float)[:, None]
+        return (np.exp(num_our * log_cdf) - np.exp(num_our * log_prev)) @ you_lose
+
+    if you_lose[-1] > prob:
+        return max_num_our
+
+    minus, plus = 1, num_you
+    while prob_you([plus])[0] > prob:
+        minus = plus
+        plus *= 2
+    while plus > minus + block:
+        tests = np.linspace(minus, plus, block + 1, dtype=int)[1:-1]
+        above = tests[prob_you(tests) > prob]
+        if len(above):
+            minus = int(above[-1])
+        plus = int(tests[len(above)]) if len(above) < len(tests) else plus
+    if plus > minus + 1:
+        tests = np.arange(minus + 1, plus)
+        below = np.flatnonzero(prob_you(tests) <= prob)
+        if len(below):
+            plus = int(tests[below[0]])
+
+    return plus
 
 
 class AbstractProgram:
@@ -27,6 +68,9 @@ class AbstractProgram:
     def unpause(self, m):
         pass
 
+    def upcoming(self, m, n):
+        return []
+
 
 class ShowProgram(AbstractProgram):
 
@@ -42,6 +86,10 @@ class ShowProgram(AbstractProgram):
     def make_current(self, m, *args, **kwargs):
         self.pic(m)
 
+    def upcoming(self, m, n):
+        picker = self.picker or m.st.picker()
+        return picker.peek(n)
+
     def key(self, m, event):
         if event.key() == Qt.Key_P:
             self.picker = m.get_picker() or self.picker
@@ -83,50 +131,142 @@ class SyncProgram(AbstractProgram):
 
     def __init__(self, m):
         self.del_ids = m.db.get_delete_ids()
-        ret = m.db.get_remote()
-        ndel, nmov, self.staged = m.db.sync_local()
+        self.staged = m.db.staged()
+        self.data = {'del_loc': len(self.del_ids), 'new_inc': 0, 'dup_inc': 0}
+        self.moves = {}
+        self.finishing = False
+        self.note = ''
+        self.checked = None
 
-        self.data = {
-            'new_loc': int(re.search(r'Number of created files: (?P<n>\d+)', ret).group('n')),
-            'del_loc': int(re.search(r'Number of deleted files: (?P<n>\d+)', ret).group('n')),
-            'del_inc': ndel,
-            'mov_inc': nmov,
-            'del_loc': len(self.del_ids),
-        }
+        conf = m.db.ingest
+        self.ingest = Ingest(m.db, self.staged[::-1], distance=int(conf['distance']),
+                             backfill=int(conf['backfill']))
+        self.skip_duplicates = conf['duplicates'] == 'skip'
+        self.batch = int(conf['batch'])
+
+        self.pull = m.db.get_remote()
+        self.push = None
+        self.timer = m.start_timer(200, self.poll)
 
-        self.moves = {}
         m.register(self)
         self.next(m)
 
+    def status(self, m, text=''):
+        m.show_status(' | '.join(s for s in (text, self.note) if s))
+
+    def poll(self, m, timer):
+        if self.staged and self.checked != self.staged[-1] and m.programs[-1] is self:
+            if self.check(m):
+                self.next(m)
+            elif self.checked == self.staged[-1]:
+                self.status(m)
+        if self.pull is not None:
+            self.status(m, 'Pulling: ' + self.pull.describe())
+            if self.pull.poll():
+                self.pulled(m)
+        elif self.push is not None:
+            self.status(m, 'Pushing: ' + self.push.describe())
+            if self.push.poll() and m.programs[-1] is self:
+                self.pushed(m)
+
+    def pulled(self, m):
+        pull, self.pull = self.pull, None
+        if pull.error:
+            m.show_message('Pull failed: {}'.format(pull.error))
+        self.data['new_loc'] = pull['created']
+
+        self.data['del_inc'], self.data['mov_inc'], staged = m.db.sync_local()
+        known = set(self.staged) | set(self.moves)
+        new = [fn for fn in staged if fn not in known]
+        self.ingest.add(new[::-1])
+        self.staged = new + self.staged
+        if len(self.moves) >= self.batch:
+            self.commit(m)
+        if self.finishing:
+            self.next(m)
+
+    def check(self, m):
+        fn = self.staged[-1]
+        if fn == self.checked or not self.ingest.ready(fn):
+            return False
+        self.checked = fn
+        dup = self.ingest.duplicate(fn, wait=False)
+        if dup is not None and self.skip_duplicates:
+            self.staged.pop()
+            Journal.move(fn, join(dirname(fn), '.duplicates', basename(fn)))
+            self.data['dup_inc'] += 1
+            return True
+        self.note = 'Duplicate of {}'.format(m.db.describe(dup)) if dup is not None else ''
+        return False
+
     def next(self, m):
+        while self.staged and self.check(m):
+            pass
         if self.staged:
-            fn = self.staged[-1]
+            if self.checked != self.staged[-1]:
+                self.note = ''
+            self.status(m)
             m.show_image(self.staged[-1])
+        elif self.pull is not None:
+            self.finishing = True
+            m.show_image(None)
         else:
-            if self.del_ids:
-                for pic in m.db.query().filter(Picture.id.in_(self.del_ids)):
-                    m.db.delete(pic)
-            m.db.session.add_all(self.moves.values())
-            m.db.session.commit()
-
-            for fn, pic in self.moves.items():
-                run(['mv', fn, pic.filename])
-
-            ret = m.db.put_remote()
-            self.data['new_rem'] = int(re.search(r'Number of created files: (?P<n>\d+)', ret).group('n'))
-            self.data['del_rem'] = int(re.search(r'Number of deleted files: (?P<n>\d+)', ret).group('n'))
-            m.show_message("""New from remote: {new_loc}<br>
-                                 Previously deleted remotely: {del_loc}<br>
-                                 Deleted from DB: {del_inc}<br>
-                                 Deleted locally: {del_loc}<br>
-                                 Re-staged: {mov_inc}<br>
-                                 New on remote: {new_rem}<br>
-                                 Newly deleted remotely: {del_rem}""".format(**self.data),
-                              align='left')
+            self.finish(m)
+
+    def commit(self, m, journal=None):
+        journal = journal or m.db.journal()
+        pics = list(self.moves.values())
+        m.db.session.add_all(pics)
+        m.db.session.flush()
+        for fn, pic in self.moves.items():
+            journal.rename(fn, pic.filename, pic.id)
+        m.db.store_fingerprints(self.ingest.rows(self.moves))
+        m.db.updated(*pics)
+        m.db.commit(journal)
+        self.data['new_inc'] += len(pics)
+        self.moves = {}
+        if pics:
+            Thread(target=m.db.renditions.fill, daemon=True,
+                   args=(pics, m.screen.width(), m.screen.height())).start()
 
-            m.unregister()
+    def finish(self, m):
+        self.note = ''
+        self.ingest.cancel()
+        journal = m.db.journal()
+        if self.del_ids:
+            for pic in m.db.get_pictures(self.del_ids):
+                m.db.delete(pic, journal)
+        self.commit(m, journal)
+
+        self.push = m.db.put_remote()
+
+    def pushed(self, m):
+        self.timer.stop()
+        m.show_status('')
+        push, self.push = self.push, None
+        if push.error:
+            m.show_message('Push failed: {}'.format(push.error))
+        self.data['new_rem'] = push['created']
+        self.data['del_rem'] = push['deleted']
+        m.show_message("""New from remote: {new_loc}<br>
+                             Previously deleted remotely: {del_loc}<br>
+                             Deleted from DB: {del_inc}<br>
+                             Deleted locally: {del_loc}<br>
+                             Re-staged: {mov_inc}<br>
+                             Added: {new_inc}<br>
+                             Skipped duplicates: {dup_inc}<br>
+                             New on remote: {new_rem}<br>
+                             Newly deleted remotely: {del_rem}""".format(**self.data),
+                          align='left')
+
+        m.unregister()
+
+    def upcoming(self, m, n):
+        return self.staged[-2:-n-2:-1]
 
     def key(self, m, event):
+        if not self.staged:
+            return
         flags = m.get_flags()
         if flags:
             fn = self.staged.pop()
@@ -134,12 +274,15 @@ class SyncProgram(AbstractProgram):
             if extension == 'jpeg':
                 extension = 'jpg'
 
-            pic = Picture()
+            pic = m.db.Picture()
             pic.extension = extension
             for k, v in flags.items():
                 setattr(pic, k, v)
 
             self.moves[fn] = pic
+            self.ingest.accept(fn)
+            if self.pull is None and len(self.moves) >= self.batch:
+                self.commit(m)
             self.next(m)
 
 
@@ -147,6 +290,7 @@ class BestOfGame(ShowProgram):
 
     def __init__(self, m):
         self.picker = m.st.bestof_picker
+        self.pools = m.st.bestof_pools
 
         self.pts = {True: [0, 0, 0], False: [0, 0, 0]}
         self.max_pts = [5, 5, 10]
@@ -184,9 +328,7 @@ class BestOfGame(ShowProgram):
         conv = lambda p: self.speed * p
         threshold = conv(p(self.bias) if self.current else 1 - p(self.bias))
         win = random() <= threshold
-        pic = self.picker.get()
-        while m.st.bestof_trigger(pic) != win:
-            pic = self.picker.get()
+        pic = self.pools[win].get()
         m.show_image(pic)
 
         if not win:
@@ -231,6 +373,9 @@ class BestOfGame(ShowProgram):
     def make_current(self, m, *args, **kwargs):
         self.next(m)
 
+    def upcoming(self, m, n):
+        return self.pools[True].peek(n) + self.pools[False].peek(n)
+
     def key(self, m, event):
         self.next(m)
 
@@ -263,43 +408,18 @@ class StatusProgram(AbstractProgram):
 class PermissionProgram(AbstractProgram):
 
     @staticmethod
-    def num_our(dist_our, dist_you, num_you, prob):
-        max_num = max(dist_our[-1], dist_you[-1])
-        your_cumdist = np.zeros((max_num+1,), dtype=float)
-        for n, g in groupby(dist_you):
-            your_cumdist[n:] += len(list(g)) / len(dist_you)
-        your_cumdist = 1.0 - your_cumdist ** num_you
-
-        our_cumdist = np.zeros((max_num+1,), dtype=float)
-        for n, g in groupby(dist_our):
-            our_cumdist[n:] += len(list(g)) / len(dist_you)
-
-        def prob_you(num_our):
-            our = our_cumdist.copy() ** num_our
-            prob = our[0] * your_cumdist[0]
-            prob += sum((our[1:] - our[:-1]) * your_cumdist[1:])
-            return prob
-
-        minus, plus = 1, num_you
-        while prob_you(plus) > prob:
-            minus = plus
-            plus *= 2
-        while plus > minus + 1:
-            test = (minus + plus) // 2
-            if prob_you(test) > prob:
-                minus = test
-            else:
-                plus = test
-
-        return plus
+    def num_our(hist_our, hist_you, num_you, prob):
+        return solve_num_our(tuple(sorted(hist_our.items())),
+                             tuple(sorted(hist_you.items())),
+                             int(num_you), float(prob))
 
     def __init__(self, m):
         self.picker_you = m.st.perm_yours
         self.picker_our = m.st.perm_ours
 
-        dist_our = sorted([m.st.perm_value(p) for p in self.picker_our.get_all()])
-        dist_you = sorted([m.st.perm_value(p) for p in self.picker_you.get_all()])
-        self.num_our = PermissionProgram.num_our(dist_our, dist_you,
+        hist_our = self.picker_our.histogram(m.st.perm_value)
+        hist_you = self.picker_you.histogram(m.st.perm_value)
+        self.num_our = PermissionProgram.num_our(hist_our, hist_you,
                                                  m.st.perm_num,
                                                  m.st.perm_prob)
         self.remaining = m.st.perm_num
@@ -386,6 +506,9 @@ class PermissionProgram(AbstractProgram):
             self.until = now + timedelta(seconds=until)
             self.before = now + timedelta(seconds=before)
 
+    def upcoming(self, m, n):
+        return self.picker.peek(n)
+
     def key(self, m, event):
         self.next(m)
 
@@ -1,15 +1,28 @@
+from timing import phase
+
 from sys import exit
-from yaml import load
 import atexit
+import logging
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s: %(message)s')
 
-from gui import run_gui
-from db import DB
+with phase('imports'):
+    from compiled import ConfigCache
+    from gui import run_gui
+    from db import DB
+    from federation import Federation
 
 
 if __name__ == '__main__':
-    with open('config.yaml', 'r') as f:
-        config = load(f)
-    db = DB(config['db'])
+    with phase('config'):
+        cache = ConfigCache('config.yaml')
+        config = cache.config
+    with phase('db'):
+        if config['db']['pics'].get('libraries'):
+            db = Federation(config['db'])
+        else:
+            db = DB(config['db'])
+    cache.save()
     msg = db.status.update()
     atexit.register(db.status.put)
-    exit(run_gui(db, msg))
+    exit(run_gui(db, config.get('gui', {}), msg))
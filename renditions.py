@@ -0,0 +1,114 @@
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from multiprocessing import get_context
+from os import makedirs, remove, replace, scandir, utime
+from os.path import getsize, join
+from threading import Lock
+
+from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QImage
+
+
+def render(src, dst, width, height):
+    image = QImage(src)
+    if image.isNull():
+        return 0
+    if image.width() > width or image.height() > height:
+        image = image.scaled(width, height, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+    tmp = dst + '.tmp'
+    if not image.save(tmp, 'JPG', 90):
+        return 0
+    replace(tmp, dst)
+    return getsize(dst)
+
+
+class RenditionCache:
+
+    def __init__(self, root, limit=2048, workers=None):
+        self.root = root
+        self.limit = limit * 1024 * 1024
+        self.workers = workers
+        self.lock = Lock()
+        self._pool = None
+        self.rendering = set()
+
+        makedirs(root, exist_ok=True)
+        entries = []
+        for e in scandir(root):
+            if e.name.endswith('.jpg'):
+                stat = e.stat()
+                entries.append((stat.st_mtime, e.name, stat.st_size))
+        self.entries = OrderedDict((name, size) for _, name, size in sorted(entries))
+        self.names = defaultdict(set)
+        for name in self.entries:
+            self.names[int(name.split('-')[0])].add(name)
+        self.total = sum(self.entries.values())
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=get_context('spawn'))
+        return self._pool
+
+    @staticmethod
+    def name(idx, width, height):
+        return '{idx:0>8}-{w}x{h}.jpg'.format(idx=idx, w=width, h=height)
+
+    def path(self, pic, width, height):
+        name = self.name(pic.id, width, height)
+        fn = join(self.root, name)
+        with self.lock:
+            cached = name in self.entries
+            if cached:
+                self.entries.move_to_end(name)
+            elif name not in self.rendering:
+                self.rendering.add(name)
+                future = self.pool.submit(render, pic.filename, fn, width, height)
+                future.add_done_callback(lambda f: self.rendered(pic.id, name, f))
+        if cached:
+            utime(fn)
+            return fn
+        return pic.filename
+
+    def rendered(self, idx, name, future):
+        with self.lock:
+            self.rendering.discard(name)
+        if not future.cancelled() and future.exception() is None and future.result():
+            self.insert(idx, name, future.result())
+
+    def fill(self, pics, width, height):
+        with self.lock:
+            pics = {self.name(p.id, width, height): p for p in pics}
+            pics = {name: p for name, p in pics.items() if name not in self.entries}
+        names = list(pics)
+        srcs = [pics[name].filename for name in names]
+        dsts = [join(self.root, name) for name in names]
+        sizes = self.pool.map(render, srcs, dsts, repeat(width), repeat(height), chunksize=16)
+        for name, size in zip(names, sizes):
+            if size:
+                self.insert(pics[name].id, name, size)
+
+    def insert(self, idx, name, size):
+        with self.lock:
+            self.total += size - self.entries.get(name, 0)
+            self.entries[name] = size
+            self.names[idx].add(name)
+            while self.total > self.limit and len(self.entries) > 1:
+                old, old_size = self.entries.popitem(last=False)
+                self.names[int(old.split('-')[0])].discard(old)
+                self.total -= old_size
+                self.unlink(old)
+
+    def discard(self, *ids):
+        with self.lock:
+            for idx in ids:
+                for name in self.names.pop(idx, ()):
+                    self.total -= self.entries.pop(name, 0)
+                    self.unlink(name)
+
+    def unlink(self, name):
+        try:
+            remove(join(self.root, name))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,18 @@
+from compiled import load_yaml
+
+from db import DB
+from federation import Federation
+
+
+if __name__ == '__main__':
+    with open('config.yaml', 'r') as f:
+        config = load_yaml(f)
+    if config['db']['pics'].get('libraries'):
+        shards = Federation(config['db']).shards
+    else:
+        shards = [DB(config['db'])]
+    for db in shards:
+        moved = 0
+        for n in db.reshard():
+            moved += n
+            print('Moved {} pictures in {}'.format(moved, db.Picture.root))
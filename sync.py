@@ -0,0 +1,351 @@
+from collections import defaultdict
+from hashlib import sha1
+from os import scandir, sep, stat
+from os.path import isfile, join
+from subprocess import CalledProcessError, DEVNULL, Popen, PIPE
+from tempfile import NamedTemporaryFile
+from threading import Condition, Lock, Thread
+from time import monotonic
+import json
+import re
+import sqlite3
+
+from timing import log
+
+
+MANIFEST = '.manifest.db'
+DIGEST = '.manifest.digest'
+MUTABLE = ('.db',)
+
+
+PROGRESS = re.compile(r'^\s*(?P<bytes>[\d,]+)\s+(?P<percent>\d+)%\s+(?P<rate>\S+/s)')
+
+
+class Transfer(Thread):
+
+    def __init__(self, job, finish=None):
+        super(Transfer, self).__init__(daemon=True)
+        self.job = job
+        self.finish = finish
+        self.lock = Lock()
+        self.progress = {'files': 0, 'created': 0, 'deleted': 0,
+                         'bytes': 0, 'percent': 0, 'rate': ''}
+        self.error = None
+        self.finished = False
+        self.start()
+
+    def run(self):
+        try:
+            self.job(self)
+        except (OSError, CalledProcessError) as e:
+            self.error = e
+
+    def poll(self):
+        if self.is_alive():
+            return False
+        if not self.finished:
+            self.finished = True
+            if self.finish:
+                self.finish()
+        return True
+
+    def __getitem__(self, key):
+        with self.lock:
+            return self.progress[key]
+
+    def describe(self):
+        with self.lock:
+            p = dict(self.progress)
+        return '{files} files, {mb:.1f} MB ({percent}%), {rate}'.format(mb=p['bytes'] / 1e6, **p)
+
+    def parse(self, line):
+        with self.lock:
+            if line.startswith('*deleting'):
+                self.progress['deleted'] += 1
+            elif line[:2] in {'>f', '<f'}:
+                self.progress['files'] += 1
+                if line[2:11] == '+++++++++':
+                    self.progress['created'] += 1
+            else:
+                m = PROGRESS.match(line)
+                if m:
+                    self.progress['bytes'] = int(m.group('bytes').replace(',', ''))
+                    self.progress['percent'] = int(m.group('percent'))
+                    self.progress['rate'] = m.group('rate')
+
+    def rsync(self, *args, files=None, track=True):
+        cmd = ['rsync', '-a', '--itemize-changes', '--info=progress2'] + list(args)
+        with NamedTemporaryFile('w', suffix='.files') as listing:
+            if files is not None:
+                listing.write(''.join(fn + '\n' for fn in files))
+                listing.flush()
+                cmd.insert(-2, '--files-from=' + listing.name)
+            proc = Popen(cmd, stdout=PIPE, stderr=DEVNULL if not track else None)
+            buf = b''
+            for chunk in iter(lambda: proc.stdout.read1(4096), b''):
+                buf += chunk
+                *lines, buf = re.split(rb'[\r\n]', buf)
+                if track:
+                    for line in lines:
+                        self.parse(line.decode(errors='replace'))
+            if track:
+                self.parse(buf.decode(errors='replace'))
+            if proc.wait():
+                raise CalledProcessError(proc.returncode, cmd)
+
+
+class Transfers:
+
+    def __init__(self, transfers):
+        self.transfers = transfers
+
+    @property
+    def error(self):
+        return next((t.error for t in self.transfers if t.error), None)
+
+    def poll(self):
+        return all([t.poll() for t in self.transfers])
+
+    def __getitem__(self, key):
+        return sum(t[key] for t in self.transfers)
+
+    def describe(self):
+        return ' | '.join(t.describe() for t in self.transfers)
+
+
+class Debouncer(Thread):
+
+    def __init__(self, func, delay=0.0):
+        super(Debouncer, self).__init__(daemon=True)
+        self.func = func
+        self.delay = delay
+        self.cond = Condition()
+        self.pending = False
+        self.running = False
+        self.payload = None
+        self.due = 0.0
+        self.start()
+
+    def schedule(self, payload=None):
+        with self.cond:
+            self.pending = True
+            self.payload = payload
+            self.due = monotonic() + self.delay
+            self.cond.notify()
+
+    def cancel(self):
+        with self.cond:
+            pending, self.pending = self.pending, False
+            while self.running:
+                self.cond.wait()
+            return pending, self.payload
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending or monotonic() < self.due:
+                    self.cond.wait(self.due - monotonic() if self.pending else None)
+                self.pending = False
+                self.running = True
+                payload = self.payload
+            try:
+                self.func(payload)
+            except (OSError, CalledProcessError) as e:
+                log.warning('Background task failed: %s', e)
+            finally:
+                with self.cond:
+                    self.running = False
+                    self.cond.notify_all()
+
+
+def remote_path(remote, name):
+    return remote.rstrip('/') + '/' + name
+
+
+def hash_file(fn):
+    sha = sha1()
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def entry_digest(name, hash):
+    return int(sha1('{}:{}'.format(name, hash).encode()).hexdigest()[:16], 16)
+
+
+class Manifest:
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode = PERSIST')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS entries ('
+                          'name TEXT PRIMARY KEY, id INTEGER, size INTEGER, '
+                          'mtime INTEGER, hash TEXT)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    @property
+    def digest(self):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'digest'").fetchone()
+        return int(row[0], 16) if row else 0
+
+    @digest.setter
+    def digest(self, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('digest', ?)", ('{:016x}'.format(value),))
+
+    @property
+    def directories(self):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'directories'").fetchone()
+        return json.loads(row[0]) if row else {}
+
+    @directories.setter
+    def directories(self, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('directories', ?)", (json.dumps(value),))
+
+    def entries(self):
+        return {name: (size, mtime, hash) for name, size, mtime, hash
+                in self.conn.execute('SELECT name, size, mtime, hash FROM entries')}
+
+    def put(self, name, size, mtime, hash, old=None):
+        digest = self.digest
+        if old is not None:
+            digest ^= entry_digest(name, old)
+        idx = name.rpartition('/')[2].split('.')[0]
+        self.conn.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)',
+                          (name, int(idx) if idx.isdigit() else None, size, mtime, hash))
+        self.digest = digest ^ entry_digest(name, hash)
+
+    def drop(self, name, old):
+        self.conn.execute('DELETE FROM entries WHERE name = ?', (name,))
+        self.digest ^= entry_digest(name, old)
+
+    def check(self, known, name, fn, st):
+        old = known.pop(name, None)
+        if old is None or old[:2] != (st.st_size, st.st_mtime_ns):
+            self.put(name, st.st_size, st.st_mtime_ns, hash_file(fn), old[2] if old else None)
+
+    def refresh(self, root):
+        known = self.entries()
+        files = defaultdict(list)
+        for name in known:
+            files[parent(name)].append(name)
+        before, after = self.directories, {}
+        pending = ['']
+        while pending:
+            prefix = pending.pop()
+            try:
+                mtime = stat(join(root, prefix)).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            after[prefix] = mtime
+            if before.get(prefix) == mtime:
+                pending.extend(d for d in before if d and parent(d[:-1]) == prefix)
+                for name in files[prefix]:
+                    if not name.endswith(MUTABLE):
+                        known.pop(name)
+                    elif isfile(join(root, name)):
+                        self.check(known, name, join(root, name), stat(join(root, name)))
+                continue
+            for e in scandir(join(root, prefix)):
+                if not tracked(e.name):
+                    continue
+                if e.is_dir():
+                    pending.append(prefix + e.name + '/')
+                elif e.is_file():
+                    self.check(known, prefix + e.name, e.path, e.stat())
+        for name, (_, _, hash) in known.items():
+            self.drop(name, hash)
+        self.directories = after
+        self.conn.commit()
+
+    def diff(self, other):
+        ours, theirs = self.entries(), other.entries()
+        names = {n for n, e in theirs.items() if n not in ours or ours[n][2] != e[2]}
+        return sorted(names | (set(ours) - set(theirs)))
+
+    def adopt(self, other, names, root):
+        ours, theirs = self.entries(), other.entries()
+        for name in names:
+            old = ours[name][2] if name in ours else None
+            fn = join(root, name)
+            if name in theirs and isfile(fn):
+                st = stat(fn)
+                self.put(name, st.st_size, st.st_mtime_ns, theirs[name][2], old)
+            elif old is not None:
+                self.drop(name, old)
+        self.conn.commit()
+
+
+def tracked(name):
+    return not name.startswith('.') and not name.endswith(('-journal', '-wal', '-shm'))
+
+
+def parent(name):
+    head, sep, _ = name.rpartition('/')
+    return head + sep
+
+
+def fetch_digest(t, root, remote):
+    path = join(root, '.manifest.remote.digest')
+    try:
+        t.rsync('--inplace', remote_path(remote, DIGEST), path, track=False)
+        with open(path, 'r') as f:
+            return int(f.read().strip(), 16)
+    except (CalledProcessError, ValueError):
+        return None
+
+
+def fetch_manifest(t, root, remote):
+    try:
+        t.rsync('--inplace', remote_path(remote, MANIFEST), join(root, '.manifest.remote.db'), track=False)
+    except CalledProcessError:
+        return None
+    return Manifest(join(root, '.manifest.remote.db'))
+
+
+def publish_manifest(t, root, remote, manifest):
+    with open(join(root, DIGEST), 'w') as f:
+        f.write('{:016x}\n'.format(manifest.digest))
+    manifest.close()
+    t.rsync(join(root, MANIFEST), join(root, DIGEST), remote.rstrip('/') + '/', track=False)
+
+
+def pull(t, root, remote):
+    local = Manifest(join(root, MANIFEST))
+    local.refresh(root)
+    digest = fetch_digest(t, root, remote)
+    if digest == local.digest:
+        local.close()
+        return
+    theirs = fetch_manifest(t, root, remote) if digest is not None else None
+    if theirs is None:
+        t.rsync('--delete', '--exclude=/.*', remote, root + sep)
+        local.refresh(root)
+    else:
+        names = local.diff(theirs)
+        t.rsync('--delete-missing-args', remote.rstrip('/') + '/', root + sep, files=names)
+        local.adopt(theirs, names, root)
+        theirs.close()
+    local.close()
+
+
+def push(t, root, remote):
+    local = Manifest(join(root, MANIFEST))
+    local.refresh(root)
+    digest = fetch_digest(t, root, remote)
+    if digest == local.digest:
+        local.close()
+        return
+    theirs = fetch_manifest(t, root, remote) if digest is not None else None
+    if theirs is None:
+        t.rsync('--delete', '--exclude=/.*', root + sep, remote)
+    else:
+        t.rsync('--delete-missing-args', root + sep, remote.rstrip('/') + '/',
+                files=local.diff(theirs))
+        theirs.close()
+    publish_manifest(t, root, remote, local)
@@ -0,0 +1,77 @@
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from os import getpid
+from threading import Lock, get_ident
+from time import perf_counter
+import json
+import logging
+
+
+START = perf_counter()
+log = logging.getLogger('ptools')
+
+
+def since_start():
+    return (perf_counter() - START) * 1000
+
+
+@contextmanager
+def phase(name):
+    start = perf_counter()
+    yield
+    log.info('%s took %.1f ms (%.1f ms since start)', name,
+             (perf_counter() - start) * 1000, since_start())
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+class Tracer:
+
+    def __init__(self, path):
+        self.path = path
+        self.pid = getpid()
+        self.lock = Lock()
+        self.durations = defaultdict(list)
+        self.file = open(path, 'w')
+        self.file.write('[\n')
+
+    def record(self, name, start, end):
+        event = {'name': name, 'ph': 'X', 'pid': self.pid, 'tid': get_ident(),
+                 'ts': (start - START) * 1e6, 'dur': (end - start) * 1e6}
+        with self.lock:
+            if self.file is None:
+                return
+            self.durations[name].append((end - start) * 1000)
+            self.file.write(json.dumps(event) + ',\n')
+
+    def wrap(self, name, func):
+        @wraps(func)
+        def traced(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(name, start, perf_counter())
+        return traced
+
+    def instrument(self, cls, *methods):
+        for method in methods:
+            if method in cls.__dict__:
+                name = '{}.{}'.format(cls.__name__, method)
+                setattr(cls, method, self.wrap(name, cls.__dict__[method]))
+
+    def summary(self):
+        with self.lock:
+            return [(name, len(values), percentile(values, 0.5), percentile(values, 0.99))
+                    for name, values in sorted(self.durations.items())]
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+            self.file = None
+        for name, n, p50, p99 in self.summary():
+            log.info('%-32s n=%-6d p50 %8.2f ms  p99 %8.2f ms', name, n, p50, p99)